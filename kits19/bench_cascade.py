@@ -0,0 +1,72 @@
+import argparse
+import time
+
+import numpy as np
+
+from bench_cpu_backend import NullWriter
+from src.cascade import CoarseLocalizer
+from src.config import config
+from src.crop_index import load_crop_index
+from src.evaluation import Evaluator
+from src.net import build_network
+from src.score import class_metrics
+from src.utils import load_checkpoint
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--net", help="Neural network", type=str, default="3dunet")
+    parser.add_argument("--checkpoint", help="Checkpoint name", type=str, default=None)
+    parser.add_argument("--hdf", help="Val crops file", type=str, default="val_interpolated_crops.hdf5")
+    parser.add_argument("--csv", help="Val crops csv", type=str, default="val_interpolated_crops.csv")
+    parser.add_argument("--cases", help="Number of val cases (0 - all)", type=int, default=0)
+    parser.add_argument("--scales", help="Coarse pass scales D,H,W separated by ';'", type=str,
+                        default="0.5,0.25,0.25;0.25,0.125,0.125")
+    parser.add_argument("--coarse_net", help="Network of the downsampled pass (default: --net)", type=str,
+                        default=None)
+    parser.add_argument("--coarse_checkpoint", help="Checkpoint of --coarse_net", type=str, default=None)
+    parser.add_argument("--margin", help="Margin around the found kidneys, D,H,W voxels", type=str, default="8,32,32")
+    parser.add_argument("--batch", help="Batch size", type=int, default=1)
+    parser.add_argument("--workers", help="Loader workers", type=int, default=0)
+    args = parser.parse_args()
+
+    net = build_network(args.net)
+    if args.checkpoint is not None:
+        load_checkpoint(net, args.checkpoint)
+    cases = load_crop_index(args.csv).cases
+    cases = cases[:args.cases] if args.cases > 0 else cases
+    margin = [int(m) for m in args.margin.split(",")]
+    coarse_net = net
+    if args.coarse_net is not None:
+        coarse_net = build_network(args.coarse_net)
+        if args.coarse_checkpoint is not None:
+            load_checkpoint(coarse_net, args.coarse_checkpoint)
+        coarse_net = coarse_net.to(config['DEVICE']).eval()
+
+    runs = [("full", ())]
+    for scale in args.scales.split(";"):
+        localizer = CoarseLocalizer(coarse_net, scale=[float(s) for s in scale.split(",")], margin=margin,
+                                    device=config['DEVICE'], precision=config['PRECISION'], batch_size=args.batch)
+        runs.append(("cascade " + scale, (localizer,)))
+
+    print("{:28} {:>8} {:>9} {:>8} {:>8} {:>12} {:>12} {:>8}".format("mode", "skipped", "fallbacks", "score", "drop",
+                                                                     "kidney dice", "tumor dice", "time s"))
+    reference = None
+    for name, crop_filters in runs:
+        evaluator = Evaluator(net, config, writer=NullWriter())
+        start = time.perf_counter()
+        evaluator.run(cases=cases, crops_hdf_file=args.hdf, crops_csv_file=args.csv, workers=args.workers,
+                      batch_size=args.batch, should_score=True, crop_filters=crop_filters)
+        elapsed = time.perf_counter() - start
+        score = float(np.mean(evaluator.scores))
+        reference = score if reference is None else reference
+        skipped = evaluator.skipped_crops / max(evaluator.total_crops, 1)
+        dice = class_metrics(evaluator.confusion)['dice']
+        # Cases the coarse pass found nothing in, all their crops were run
+        fallbacks = sum(getattr(crop_filter, 'fallbacks', 0) for crop_filter in crop_filters)
+        print("{:28} {:8.3f} {:9} {:8.4f} {:8.4f} {:12.4f} {:12.4f} {:8.1f}".format(
+            name, skipped, fallbacks, score, reference - score, dice[1], dice[2], elapsed))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,39 @@
+import argparse
+import multiprocessing
+
+import torch
+
+from bench_precision import _bench
+from src.grad_checkpoint import CHECKPOINTING
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--nets", help="Networks of build_network", type=str, default="3dunet,grid,dsv")
+    parser.add_argument("--modes", help="Checkpointing modes to compare", type=str, default=",".join(CHECKPOINTING))
+    parser.add_argument("--crops", help="Crop sizes D,H,W separated by ';'", type=str, default="32,64,64;32,128,128")
+    parser.add_argument("--batch", help="Batch size", type=int, default=1)
+    parser.add_argument("--precision", help="Network precision", type=str, default="fp32")
+    parser.add_argument("--steps", help="Timed steps", type=int, default=3)
+    parser.add_argument("--device", help="Device", type=str, default="cuda" if torch.cuda.is_available() else "cpu")
+    args = parser.parse_args()
+
+    print("{:8} {:12} {:9} {:>12} {:>10} {:>8} {:>8}".format("net", "crop", "mode", "train s/step", "peak MB",
+                                                            "time", "memory"))
+    for net_name in args.nets.split(","):
+        for crop in args.crops.split(";"):
+            shape = (args.batch, 1) + tuple(int(s) for s in crop.split(","))
+            baseline = None
+            for mode in args.modes.split(","):
+                # A fresh process per run, so peak memory isn't carried over between runs
+                with multiprocessing.Pool(1) as pool:
+                    train, _, peak = pool.apply(_bench, ((net_name, args.precision, shape, args.steps, args.device,
+                                                          mode),))
+                # Time and memory relative to the first mode, 'none' by default
+                baseline = baseline or (train, peak)
+                print("{:8} {:12} {:9} {:12.3f} {:10.0f} {:7.2f}x {:7.2f}x".format(
+                    net_name, crop, mode, train, peak, train / baseline[0], peak / baseline[1]))
+
+
+if __name__ == "__main__":
+    main()
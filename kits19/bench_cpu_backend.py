@@ -0,0 +1,78 @@
+import argparse
+import time
+
+import numpy as np
+import torch
+
+from src.cpu_backend import CPU_BACKENDS, calibration_crops, cpu_backend
+from src.crop_index import load_crop_index
+from src.evaluation import Evaluator
+from src.net import build_network
+from src.score import class_metrics
+from src.utils import load_checkpoint
+
+
+class NullWriter:
+    "Drops the Evaluator's tensorboard scalars, only the returned scores are reported"
+
+    def add_scalar(self, *args, **kwargs):
+        pass
+
+
+def throughput(net, crops, batch_size, runs):
+    "Crops per second over `runs` batches, after a warm-up batch"
+    batch = torch.cat([crops[i % len(crops)] for i in range(batch_size)])
+    with torch.no_grad():
+        net(batch)
+        start = time.perf_counter()
+        for _ in range(runs):
+            net(batch)
+    return batch_size * runs / (time.perf_counter() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--net", help="Neural network", type=str, default="3dunet")
+    parser.add_argument("--checkpoint", help="Checkpoint name", type=str, default=None)
+    parser.add_argument("--hdf", help="Val crops file", type=str, default="val_interpolated_crops.hdf5")
+    parser.add_argument("--csv", help="Val crops csv", type=str, default="val_interpolated_crops.csv")
+    parser.add_argument("--cases", help="Number of val cases scored (0 - skip the Dice report)", type=int, default=4)
+    parser.add_argument("--backends", help="Backends to compare", type=str, default=",".join(CPU_BACKENDS))
+    parser.add_argument("--calibration", help="Crops calibrating the int8 backend", type=int, default=8)
+    parser.add_argument("--threads", help="Thread counts of the throughput benchmark", type=str, default="1,2,4,8")
+    parser.add_argument("--batch", help="Batch size", type=int, default=2)
+    parser.add_argument("--runs", help="Timed batches per thread count", type=int, default=3)
+    args = parser.parse_args()
+
+    net = build_network(args.net)
+    if args.checkpoint is not None:
+        load_checkpoint(net, args.checkpoint)
+    net.eval()
+    calibration = calibration_crops(args.hdf, args.csv, args.calibration)
+    backends = {backend: cpu_backend(net, backend, calibration) for backend in args.backends.split(",")}
+
+    if args.cases > 0:
+        cases = load_crop_index(args.csv).cases[:args.cases]
+        config = dict(DEVICE=torch.device("cpu"))
+        reference = None
+        print("{:14} {:>8} {:>8} {:>12} {:>12}".format("backend", "score", "drop", "kidney dice", "tumor dice"))
+        for backend, backend_net in backends.items():
+            evaluator = Evaluator(backend_net, config, writer=NullWriter())
+            evaluator.run(cases=cases, crops_hdf_file=args.hdf, crops_csv_file=args.csv, batch_size=args.batch,
+                          should_score=True)
+            score = float(np.mean(evaluator.scores))
+            # Drop relative to the first backend, eager fp32 by default
+            reference = score if reference is None else reference
+            dice = class_metrics(evaluator.confusion)['dice']
+            print("{:14} {:8.4f} {:8.4f} {:12.4f} {:12.4f}".format(backend, score, reference - score, dice[1], dice[2]))
+
+    print("{:14} {:>8} {:>12}".format("backend", "threads", "crops/s"))
+    for threads in (int(t) for t in args.threads.split(",")):
+        torch.set_num_threads(threads)
+        for backend, backend_net in backends.items():
+            print("{:14} {:8} {:12.2f}".format(backend, threads,
+                                                throughput(backend_net, calibration, args.batch, args.runs)))
+
+
+if __name__ == "__main__":
+    main()
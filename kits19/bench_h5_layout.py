@@ -0,0 +1,57 @@
+import argparse
+import os
+import tempfile
+import time
+
+import numpy as np
+
+from src.crop_index import load_crop_index
+from src.data import H5Dataset
+from src.h5layout import hdf5plugin
+from src.synthetic import make_synthetic_crops
+
+
+def read_latency(hdf5file, crops, reads, rng):
+    dataset = H5Dataset(hdf5file)
+    # First touch opens the file, keep it out of the measurement
+    dataset.read_crop(*crops[0])
+    timings = []
+    for idx in rng.choice(len(crops), reads):
+        start = time.perf_counter()
+        dataset.read_crop(*crops[idx])
+        timings.append(time.perf_counter() - start)
+    dataset.close()
+    return np.array(timings) * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--cases", help="Number of synthetic cases", type=int, default=4)
+    parser.add_argument("--reads", help="Random crop reads per layout", type=int, default=200)
+    parser.add_argument("--dir", help="Directory for the synthetic files", type=str, default=None)
+    args = parser.parse_args()
+
+    directory = args.dir or tempfile.mkdtemp()
+    os.makedirs(directory, exist_ok=True)
+    variants = [("v1 float64", dict(version=1)),
+                ("v2 float32", dict(version=2, image_dtype='float32')),
+                ("v2 float16", dict(version=2, image_dtype='float16')),
+                ("v2 float16 gzip", dict(version=2, image_dtype='float16', compression='gzip')),
+                ("v2 float16 lzf", dict(version=2, image_dtype='float16', compression='lzf'))]
+    if hdf5plugin is not None:
+        variants += [("v2 float16 lz4", dict(version=2, image_dtype='float16', compression='lz4')),
+                     ("v2 float16 blosc", dict(version=2, image_dtype='float16', compression='blosc'))]
+
+    print("{:18s} {:>10s} {:>10s} {:>10s}".format("layout", "size MB", "mean ms", "p95 ms"))
+    for name, layout in variants:
+        hdf5file = os.path.join(directory, name.replace(" ", "_") + ".hdf5")
+        csvfile = os.path.join(directory, "crops.csv")
+        make_synthetic_crops(hdf5file, csvfile, n_cases=args.cases, **layout)
+        crops = load_crop_index(csvfile, cache=False)
+        timings = read_latency(hdf5file, crops, args.reads, np.random.default_rng(0))
+        print("{:18s} {:10.1f} {:10.2f} {:10.2f}".format(name, os.path.getsize(hdf5file) / 2 ** 20,
+                                                       timings.mean(), np.percentile(timings, 95)))
+
+
+if __name__ == "__main__":
+    main()
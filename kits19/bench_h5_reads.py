@@ -0,0 +1,59 @@
+import argparse
+import os
+import tempfile
+import time
+
+import h5py
+import torch.utils.data
+
+from src.data import H5CropData2, h5_worker_init
+from src.synthetic import make_synthetic_crops
+
+
+class ReopeningCropData(H5CropData2):
+    "Old behaviour: open and close the HDF5 file for every crop"
+
+    def __getitem__(self, idx):
+        case_id, (z, y, x), (zw, yw, xw) = self.crops[idx]
+        file = h5py.File(self.filename, "r")
+        data = file[case_id][:, z:z + zw, y:y + yw, x:x + xw]
+        file.close()
+        return torch.from_numpy(data[0]).unsqueeze(0).float(), torch.from_numpy(data[1]).long()
+
+
+def crops_per_second(dataset, workers, batch, limit):
+    loader = torch.utils.data.DataLoader(dataset, batch_size=batch, num_workers=workers, shuffle=True,
+                                         worker_init_fn=h5_worker_init)
+    count = 0
+    start = time.perf_counter()
+    for image, target in loader:
+        count += image.shape[0]
+        if count >= limit:
+            break
+    return count / (time.perf_counter() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--cases", help="Number of synthetic cases", type=int, default=4)
+    parser.add_argument("--workers", help="Comma separated DataLoader worker counts", type=str, default="0,6")
+    parser.add_argument("--batch", help="Batch size", type=int, default=8)
+    parser.add_argument("--limit", help="Crops to read per measurement", type=int, default=512)
+    parser.add_argument("--dir", help="Directory for the synthetic crops.hdf5", type=str, default=None)
+    args = parser.parse_args()
+
+    directory = args.dir or tempfile.mkdtemp()
+    os.makedirs(directory, exist_ok=True)
+    hdf5file, csvfile = os.path.join(directory, "crops.hdf5"), os.path.join(directory, "crops.csv")
+    if not os.path.exists(hdf5file):
+        make_synthetic_crops(hdf5file, csvfile, n_cases=args.cases)
+
+    for workers in [int(w) for w in args.workers.split(",")]:
+        before = crops_per_second(ReopeningCropData(hdf5file, csvfile), workers, args.batch, args.limit)
+        after = crops_per_second(H5CropData2(hdf5file, csvfile), workers, args.batch, args.limit)
+        print("workers={:2d}  reopen per crop: {:8.1f} crops/s  pooled handle: {:8.1f} crops/s  ({:.2f}x)"
+              .format(workers, before, after, after / before))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,97 @@
+import argparse
+import multiprocessing
+import resource
+import time
+
+import torch
+import torch.nn as nn
+
+from src.precision import PRECISIONS, autocast, autocast_dtype, grad_scaler
+
+
+def current_rss():
+    "Resident set size of this process in bytes"
+    with open("/proc/self/statm") as f:
+        return int(f.read().split()[1]) * resource.getpagesize()
+
+
+def bench(net_name, precision, shape, steps, device, checkpointing='none'):
+    """(train step seconds, inference step seconds, peak MB) of a network. On CPU the peak is the growth of
+    the process' maximum resident set over the steps, so every run needs a fresh process"""
+    from src.net import build_network
+
+    device = torch.device(device)
+    net = build_network(net_name, checkpointing=checkpointing).to(device)
+    optimizer = torch.optim.Adam(net.parameters(), lr=1e-4)
+    scaler = grad_scaler(precision, device)
+    loss_function = nn.CrossEntropyLoss()
+    image = torch.randn(shape, device=device)
+    target = torch.randint(0, 3, (shape[0], *shape[2:]), device=device)
+
+    def sync():
+        if device.type == 'cuda':
+            torch.cuda.synchronize()
+
+    def train_step():
+        optimizer.zero_grad()
+        with autocast(precision, device):
+            loss = loss_function(net(image), target)
+        scaler.scale(loss).backward()
+        scaler.step(optimizer)
+        scaler.update()
+
+    def inference_step():
+        with torch.no_grad(), autocast(precision, device):
+            net(image)
+
+    if device.type == 'cuda':
+        torch.cuda.reset_peak_memory_stats(device)
+        baseline = torch.cuda.memory_allocated(device)
+    else:
+        baseline = current_rss()
+    times = []
+    for step in (train_step, inference_step):
+        net.train(step is train_step)
+        # Warm-up step, kernels are selected and buffers allocated on the first call
+        step()
+        sync()
+        start = time.perf_counter()
+        for _ in range(steps):
+            step()
+        sync()
+        times.append((time.perf_counter() - start) / steps)
+    if device.type == 'cuda':
+        peak = torch.cuda.max_memory_allocated(device) - baseline
+    else:
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024 - baseline
+    return times[0], times[1], peak / 2 ** 20
+
+
+def _bench(task):
+    return bench(*task)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--nets", help="Networks of build_network", type=str, default="3dunet,grid,dsv")
+    parser.add_argument("--precisions", help="Precisions to compare", type=str, default=",".join(PRECISIONS))
+    parser.add_argument("--shape", help="Batch shape B,C,D,H,W", type=str, default="1,1,32,128,128")
+    parser.add_argument("--steps", help="Timed steps", type=int, default=3)
+    parser.add_argument("--device", help="Device", type=str, default="cuda" if torch.cuda.is_available() else "cpu")
+    args = parser.parse_args()
+    shape = tuple(int(s) for s in args.shape.split(","))
+
+    print("{:8} {:9} {:>8} {:>12} {:>12} {:>10}".format("net", "precision", "autocast", "train s/step",
+                                                      "infer s/step", "peak MB"))
+    for net_name in args.nets.split(","):
+        for precision in args.precisions.split(","):
+            dtype = autocast_dtype(precision, args.device)
+            # A fresh process per run, so peak memory isn't carried over between runs
+            with multiprocessing.Pool(1) as pool:
+                train, inference, peak = pool.apply(_bench, ((net_name, precision, shape, args.steps, args.device),))
+            print("{:8} {:9} {:>8} {:12.3f} {:12.3f} {:10.0f}".format(
+                net_name, precision, str(dtype).replace("torch.", "") if dtype else "-", train, inference, peak))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,49 @@
+import argparse
+import time
+
+import numpy as np
+
+from src.score import class_metrics, score_function_counts, score_function_fast
+from src.synthetic import synthetic_case
+
+
+def timed(function, *args):
+    start = time.perf_counter()
+    result = function(*args)
+    return result, time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--shape", help="Case shape D,H,W", type=str, default="128,512,512")
+    parser.add_argument("--repeats", help="Timed runs per function", type=int, default=3)
+    args = parser.parse_args()
+    shape = tuple(int(s) for s in args.shape.split(","))
+
+    rng = np.random.default_rng(0)
+    _, gt = synthetic_case(shape, rng)
+    gt = gt.astype(np.uint8)
+    # Prediction: ground truth with 2% of the voxels relabeled
+    prediction = gt.copy()
+    noise = rng.random(shape) < 0.02
+    prediction[noise] = rng.integers(0, 3, noise.sum())
+    prediction = prediction[None]
+
+    # First calls compile the numba functions
+    score_function_fast(prediction[:, :2], gt[:2])
+    score_function_counts(prediction[:, :2], gt[:2])
+
+    old = min(timed(score_function_fast, prediction, gt)[1] for _ in range(args.repeats))
+    new = min(timed(score_function_counts, prediction, gt)[1] for _ in range(args.repeats))
+    old_score = score_function_fast(prediction, gt)
+    new_score, counts = score_function_counts(prediction, gt)
+
+    print("{} voxels".format(gt.size))
+    print("score_function_fast:   {:8.3f} s  score {:.6f}".format(old, old_score))
+    print("score_function_counts: {:8.3f} s  score {:.6f}  ({:.1f}x)".format(new, new_score, old / new))
+    for name, values in class_metrics(counts).items():
+        print("  {:13s} {}".format(name, np.array2string(values, precision=4)))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,87 @@
+import argparse
+import time
+
+import numpy as np
+import torch
+
+from bench_cpu_backend import NullWriter
+from src.config import config
+from src.crop_index import load_crop_index
+from src.evaluation import Evaluator
+from src.net import build_network
+from src.precision import autocast
+from src.score import class_metrics
+from src.tta import FLIP_AXES, flip_predict, flip_variants
+from src.utils import load_checkpoint
+
+
+def tta_throughput(net, variants, shape, runs, device, precision):
+    "Crops per second through flip_predict, counting each crop once however many variants it has"
+    image = torch.randn(shape, device=device)
+
+    def step():
+        with autocast(precision, device):
+            flip_predict(net, image, variants)
+        if device.type == 'cuda':
+            torch.cuda.synchronize()
+
+    with torch.no_grad():
+        # Warm-up step, kernels are selected and buffers allocated on the first call
+        step()
+        start = time.perf_counter()
+        for _ in range(runs):
+            step()
+    return shape[0] * runs / (time.perf_counter() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--net", help="Neural network", type=str, default="3dunet")
+    parser.add_argument("--checkpoint", help="Checkpoint name", type=str, default=None)
+    parser.add_argument("--hdf", help="Val crops file", type=str, default="val_interpolated_crops.hdf5")
+    parser.add_argument("--csv", help="Val crops csv", type=str, default="val_interpolated_crops.csv")
+    parser.add_argument("--cases", help="Number of val cases scored (0 - skip the Dice report)", type=int, default=4)
+    parser.add_argument("--tta", help="Variant counts to compare", type=str, default="1,2,4,8")
+    parser.add_argument("--axes", help="Flipped axes, some of " + "".join(FLIP_AXES), type=str, default="dhw")
+    parser.add_argument("--shape", help="Crop batch shape B,C,D,H,W of the throughput benchmark", type=str,
+                        default="1,1,64,128,128")
+    parser.add_argument("--batch", help="Crops per batch of the scored runs", type=int, default=1)
+    parser.add_argument("--runs", help="Timed batches per variant count", type=int, default=3)
+    parser.add_argument("--workers", help="Loader workers", type=int, default=0)
+    args = parser.parse_args()
+
+    device = config['DEVICE']
+    net = build_network(args.net)
+    if args.checkpoint is not None:
+        load_checkpoint(net, args.checkpoint)
+    net.to(device).eval()
+    counts = [int(c) for c in args.tta.split(",")]
+    shape = tuple(int(s) for s in args.shape.split(","))
+
+    print("{:>4} {:>12} {:>10}".format("tta", "crops/s", "slowdown"))
+    reference = None
+    for count in counts:
+        rate = tta_throughput(net, flip_variants(args.axes, count), shape, args.runs, device, config['PRECISION'])
+        reference = rate if reference is None else reference
+        print("{:4} {:12.2f} {:10.2f}".format(count, rate, reference / rate))
+
+    if args.cases > 0:
+        cases = load_crop_index(args.csv).cases[:args.cases]
+        print("{:>4} {:>8} {:>8} {:>12} {:>12} {:>8}".format("tta", "score", "gain", "kidney dice", "tumor dice",
+                                                            "time s"))
+        reference = None
+        for count in counts:
+            evaluator = Evaluator(net, config, writer=NullWriter())
+            start = time.perf_counter()
+            evaluator.run(cases=cases, crops_hdf_file=args.hdf, crops_csv_file=args.csv, workers=args.workers,
+                          batch_size=args.batch, should_score=True, tta=flip_variants(args.axes, count))
+            elapsed = time.perf_counter() - start
+            score = float(np.mean(evaluator.scores))
+            reference = score if reference is None else reference
+            dice = class_metrics(evaluator.confusion)['dice']
+            print("{:4} {:8.4f} {:8.4f} {:12.4f} {:12.4f} {:8.1f}".format(count, score, score - reference, dice[1],
+                                                                         dice[2], elapsed))
+
+
+if __name__ == "__main__":
+    main()
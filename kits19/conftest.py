@@ -0,0 +1,5 @@
+import os
+import sys
+
+# Tests import the repo modules as `src.*`, like the scripts in this directory
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
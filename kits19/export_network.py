@@ -0,0 +1,48 @@
+import argparse
+import copy
+
+import torch
+
+from src.export import export_network, latency, load_exported, max_difference, save_exported
+from src.net import build_network
+from src.utils import load_checkpoint
+
+parser = argparse.ArgumentParser()
+parser.add_argument("--net", help="Neural network", type=str, default="3dunet")
+parser.add_argument("--checkpoint", help="Checkpoint name", type=str, default=None)
+parser.add_argument("--window", help="Crop size D,H,W the network is exported for", type=str, default="64,256,256")
+parser.add_argument("--no_fold", help="Keep BatchNorm layers separate", action="store_true")
+parser.add_argument("--output", help="Exported network file", type=str, default=None)
+parser.add_argument("--runs", help="Timed CPU runs of the latency benchmark (0 - skip it)", type=int, default=5)
+parser.add_argument("--threads", help="CPU threads (default: torch default)", type=int, default=None)
+
+args = parser.parse_args()
+print("Arguments: {}".format(args))
+if args.threads is not None:
+    torch.set_num_threads(args.threads)
+window = tuple(int(s) for s in args.window.split(","))
+
+net = build_network(args.net)
+extra = {}
+if args.checkpoint is not None:
+    extra = load_checkpoint(net, args.checkpoint)
+net.eval()
+eager = copy.deepcopy(net)
+
+module, metadata = export_network(net, window, fold=not args.no_fold)
+metadata.update(net=args.net, checkpoint=args.checkpoint, epoch=extra.get('epoch'))
+output = args.output or "{}.pt".format(args.net if args.checkpoint is None else args.checkpoint.rsplit(".", 1)[0])
+save_exported(module, metadata, output)
+print("Exported to {}: {}".format(output, metadata))
+
+# Parity of the saved file with the eager network
+exported, _ = load_exported(output)
+torch.manual_seed(0)
+inputs = [torch.randn((2, 1, *window)) for _ in range(2)]
+print("Max difference to eager: {:.3g}".format(max_difference(eager, exported, inputs)))
+
+if args.runs > 0:
+    x = inputs[0][:1]
+    eager_time, exported_time = latency(eager, x, args.runs), latency(exported, x, args.runs)
+    print("CPU latency per crop: eager {:.3f}s, exported {:.3f}s ({:.2f}x)".format(
+        eager_time, exported_time, eager_time / exported_time))
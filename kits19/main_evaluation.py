@@ -1,8 +1,18 @@
 import argparse
+import contextlib
 
+import torch
+
+from src.cascade import CoarseLocalizer
 from src.config import config
+from src.cpu_backend import CPU_BACKENDS, calibration_crops, cpu_backend
 from src.evaluation import Evaluator
-from src.net import build_network
+from src.h5layout import COMPRESSIONS
+from src.net import LOGIT_NETS, build_network
+from src.precision import PRECISIONS
+from src.predictions import OUTPUT_MODES
+from src.prefilter import BodyPrefilter
+from src.tta import FLIP_AXES, flip_variants
 from src.utils import load_checkpoint
 
 parser = argparse.ArgumentParser()
@@ -10,19 +20,93 @@ parser.add_argument("--evalbatch", help="Number of epochs to train", type=int, d
 parser.add_argument("--workers", help="Checkpoint name", type=int, default=6)
 parser.add_argument("--net", help="Neural network", type=str, default="3dunet")
 parser.add_argument("--checkpoint", help="Checkpoint name", type=str, default=None)
+parser.add_argument("--exported", help="Network file from export_network.py (instead of --net/--checkpoint)",
+                    type=str, default=None)
+parser.add_argument("--ensemble", help="Average the networks net:checkpoint,net:checkpoint,... "
+                                      "(instead of --net/--checkpoint)", type=str, default=None)
+parser.add_argument("--ensemble_processes", help="Run every ensemble member in its own CPU process",
+                    action="store_true")
 parser.add_argument("--score", help="Checkpoint name", type=bool, default=True)
 parser.add_argument("--file", help="File name", type=str, default="val_predictions.hdf5")
+parser.add_argument("--output_mode", help="Stored predictions: float32/float16 probabilities, "
+                                          "uint8 quantized probabilities or labels", type=str, default="float32",
+                    choices=OUTPUT_MODES)
+parser.add_argument("--output_compression", help="Compression of stored predictions", type=str, default="gzip",
+                    choices=COMPRESSIONS)
+parser.add_argument("--weighting", help="Crop weighting in the sliding window (uniform/gaussian)", type=str,
+                    default="uniform")
+parser.add_argument("--accumulate", help="Sliding window accumulator dtype (float32/float16)", type=str,
+                    default="float32")
+parser.add_argument("--boundary", help="Also compute Hausdorff 95 and average surface distance",
+                    action="store_true")
+parser.add_argument("--boundary_jobs", help="Processes computing boundary metrics", type=int, default=1)
+parser.add_argument("--backend", help="CPU inference backend (eager - the network as built)", type=str,
+                    default="eager", choices=CPU_BACKENDS)
+parser.add_argument("--calibration", help="Val crops calibrating the int8 backend", type=int, default=8)
+parser.add_argument("--cascade", help="Only run full resolution crops around the kidneys found on a downsampled "
+                                     "volume, e.g. 0.5,0.25,0.25 (D,H,W scale)", type=str, default=None)
+parser.add_argument("--cascade_net", help="Network of the downsampled pass (default: the evaluated network)",
+                    type=str, default=None)
+parser.add_argument("--cascade_checkpoint", help="Checkpoint of --cascade_net", type=str, default=None)
+parser.add_argument("--cascade_margin", help="Margin around the found kidneys, D,H,W voxels", type=str,
+                    default="8,32,32")
+parser.add_argument("--prefilter", help="Predict crops with fewer body voxels than this as background without "
+                                       "running the network", type=int, default=None)
+parser.add_argument("--prefilter_threshold", help="Normalized intensity of body voxels, for crops files "
+                                                 "without stored body sizes", type=float, default=None)
+parser.add_argument("--tta", help="Flip test-time augmentation variants per crop (1 - none)", type=int, default=1)
+parser.add_argument("--tta_axes", help="Axes flipped by --tta, some of " + "".join(FLIP_AXES), type=str,
+                    default="dhw")
+parser.add_argument("--precision", help="Network precision (bf16 on CPU for fp16)", type=str,
+                    default=config['PRECISION'], choices=PRECISIONS)
 
 args = parser.parse_args()
+if args.backend != "eager" and (args.exported is not None or args.ensemble is not None):
+    parser.error("--backend {} converts the --net/--checkpoint network, it can't be combined with "
+                 "--exported or --ensemble".format(args.backend))
+config['PRECISION'] = args.precision
 print("Arguments: {}".format(args))
 print("Config: {}".format(config))
 
-net = build_network(args.net)
-if args.checkpoint is not None:
-    extra = load_checkpoint(net, args.checkpoint)
+if args.exported is not None:
+    evaluator = Evaluator.from_exported(args.exported, config)
+elif args.ensemble is not None:
+    if args.ensemble_processes:
+        config['DEVICE'] = torch.device("cpu")
+    evaluator = Evaluator.from_ensemble(args.ensemble.split(","), config, processes=args.ensemble_processes)
+else:
+    net = build_network(args.net)
+    if args.checkpoint is not None:
+        extra = load_checkpoint(net, args.checkpoint)
+    if args.backend != "eager":
+        config['DEVICE'] = torch.device("cpu")
+        calibration = calibration_crops("val_interpolated_crops.hdf5", "val_interpolated_crops.csv",
+                                        args.calibration) if args.backend == "int8" else None
+        net = cpu_backend(net, args.backend, calibration)
+    evaluator = Evaluator(net, config, logits=args.net in LOGIT_NETS)
 
-evaluator = Evaluator(net, config)
+crop_filters = []
+if args.prefilter is not None:
+    crop_filters.append(BodyPrefilter(args.prefilter, threshold=args.prefilter_threshold))
+if args.cascade is not None:
+    coarse_net = evaluator.net
+    if args.cascade_net is not None:
+        coarse_net = build_network(args.cascade_net)
+        if args.cascade_checkpoint is not None:
+            load_checkpoint(coarse_net, args.cascade_checkpoint)
+        coarse_net = coarse_net.to(config['DEVICE']).eval()
+    localizer = CoarseLocalizer(coarse_net, scale=[float(s) for s in args.cascade.split(",")],
+                                margin=[int(m) for m in args.cascade_margin.split(",")],
+                                device=config['DEVICE'], precision=config['PRECISION'], batch_size=args.evalbatch)
+    crop_filters.append(localizer)
 
-evaluator.run(crops_csv_file="val_interpolated_crops.csv", crops_hdf_file="val_interpolated_crops.hdf5",
-              workers=args.workers, batch_size=args.evalbatch, should_score=args.score,
-              eval_file=args.file)
+# Ensemble member processes are stopped however the run ends
+with evaluator.net if args.ensemble_processes and args.ensemble is not None else contextlib.nullcontext():
+    evaluator.run(crops_csv_file="val_interpolated_crops.csv", crops_hdf_file="val_interpolated_crops.hdf5",
+                  workers=args.workers, batch_size=args.evalbatch, should_score=args.score,
+                  eval_file=args.file, weighting=args.weighting, accumulate_dtype=getattr(torch, args.accumulate),
+                  output_mode=args.output_mode, output_compression=args.output_compression,
+                  boundary_metrics=args.boundary, boundary_jobs=args.boundary_jobs, crop_filters=crop_filters,
+                  tta=flip_variants(args.tta_axes, args.tta) if args.tta > 1 else None)
+if args.cascade is not None:
+    print("Cascade found no kidney in {} cases, all their crops were run".format(localizer.fallbacks))
@@ -3,9 +3,11 @@ import argparse
 import torch.utils.data
 
 from src.config import config
-from src.data import H5CropData
+from src.data import H5CropData, h5_worker_init
+from src.grad_checkpoint import CHECKPOINTING
 from src.net import build_network
-from src.train import Trainer
+from src.precision import PRECISIONS
+from src.train import SCORE_STEP, Trainer
 from src.utils import load_checkpoint
 
 parser = argparse.ArgumentParser()
@@ -14,18 +16,25 @@ parser.add_argument("--batch", help="Number of epochs to train", type=int, defau
 parser.add_argument("--workers", help="Checkpoint name", type=int, default=6)
 parser.add_argument("--net", help="Neural network", type=str, default="3dunet")
 parser.add_argument("--checkpoint", help="Checkpoint name", type=str, default=None)
+parser.add_argument("--score_step", help="Log the training score every this many steps", type=int, default=SCORE_STEP)
+parser.add_argument("--precision", help="Network precision (bf16 on CPU for fp16)", type=str,
+                    default=config['PRECISION'], choices=PRECISIONS)
+parser.add_argument("--checkpointing", help="Blocks recomputed in backward to save activation memory", type=str,
+                    default="none", choices=CHECKPOINTING)
 
 args = parser.parse_args()
+config['PRECISION'] = args.precision
 print("Arguments: {}".format(args))
 print("Config: {}".format(config))
 
 
-net = build_network(args.net)
+net = build_network(args.net, checkpointing=args.checkpointing)
 if args.checkpoint is not None:
     extra = load_checkpoint(net, args.checkpoint)
 
 data = H5CropData("crops.hdf5", "crops.csv")
-train_loader = torch.utils.data.DataLoader(data, batch_size=args.batch, num_workers=args.workers, shuffle=True)
+train_loader = torch.utils.data.DataLoader(data, batch_size=args.batch, num_workers=args.workers, shuffle=True,
+                                           worker_init_fn=h5_worker_init)
 
-trainer = Trainer(net, config)
+trainer = Trainer(net, config, score_step=args.score_step)
 trainer.run(train_loader, epochs=args.epochs, start_epoch=extra['epoch'])
@@ -5,9 +5,11 @@ from tensorboardX import SummaryWriter
 from torch.utils.data.dataloader import default_collate
 
 from src.config import config
-from src.data import H5CropData, H5CropData2
+from src.crop_index import load_crop_index
+from src.data import CaseGroupedBatchSampler, H5CropData, H5CropData2, h5_worker_init
 from src.evaluation import Evaluator
-from src.net import build_network
+from src.grad_checkpoint import CHECKPOINTING
+from src.net import LOGIT_NETS, build_network
 from src.train import Trainer
 from src.utils import load_checkpoint
 
@@ -19,12 +21,15 @@ parser.add_argument("--workers", help="Number of workers", type=int, default=6)
 parser.add_argument("--checkpoint", help="Checkpoint name", type=str, default=None)
 parser.add_argument("--score", help="Should calculate score", type=bool, default=True)
 parser.add_argument("--net", help="Neural network", type=str, default="3dunet")
+parser.add_argument("--cache_mb", help="Per-worker cache of decoded cases, MB (0 - off)", type=int, default=0)
+parser.add_argument("--checkpointing", help="Blocks recomputed in backward to save activation memory", type=str,
+                    default="none", choices=CHECKPOINTING)
 
 args = parser.parse_args()
 print("Arguments: {}".format(args))
 print("Config: {}".format(config))
 
-net = build_network(args.net)
+net = build_network(args.net, checkpointing=args.checkpointing)
 if args.checkpoint is not None:
     extra = load_checkpoint(net, args.checkpoint)
 else:
@@ -37,15 +42,32 @@ def safe_collate(batch):
     return default_collate(batch)
 
 
-train_data = H5CropData2("data_ready/train_128_128_32.hdf5", "data_ready/train_128_128_32.csv")
-train_loader = torch.utils.data.DataLoader(train_data, batch_size=args.batch, num_workers=args.workers, shuffle=True,
-                                           collate_fn=safe_collate)
+train_data = H5CropData2("data_ready/train_128_128_32.hdf5",
+                         load_crop_index("data_ready/train_128_128_32.csv", cache=True),
+                         cache_bytes=args.cache_mb * 2 ** 20)
+# Loaded once, every epoch evaluates the same crops
+val_crops = load_crop_index("data_ready/val_128_128_32.csv", cache=True)
+# With the case cache, shuffle within case buckets so crops of a case are read while it is cached,
+# each bucket by a single worker
+batching = dict(batch_sampler=CaseGroupedBatchSampler(train_data, args.batch, workers=args.workers)) \
+    if args.cache_mb > 0 else dict(batch_size=args.batch, shuffle=True)
+if args.cache_mb > 0:
+    train_data.share_cache_stats(args.workers)
+train_loader = torch.utils.data.DataLoader(train_data, num_workers=args.workers, collate_fn=safe_collate,
+                                           worker_init_fn=h5_worker_init, **batching)
 
 tensorboard = SummaryWriter()
 trainer = Trainer(net, config, writer=tensorboard)
-evaluator = Evaluator(net, config, writer=tensorboard)
+evaluator = Evaluator(net, config, writer=tensorboard, logits=args.net in LOGIT_NETS)
 
 for epoch in range(args.epochs):
     trainer.run(train_loader, epochs=1, start_epoch=extra['epoch'] + epoch)
-    evaluator.run(crops_csv_file="data_ready/val_128_128_32.csv", crops_hdf_file="data_ready/val_128_128_32.hdf5",
+    cache_stats = train_data.cache_stats()
+    if cache_stats is not None:
+        for name, value in cache_stats.items():
+            tensorboard.add_scalar("train_cache_" + name, value, global_step=trainer.epoch_number)
+        tensorboard.add_scalar("train_cache_hit_rate",
+                               cache_stats['hits'] / max(cache_stats['hits'] + cache_stats['misses'], 1),
+                               global_step=trainer.epoch_number)
+    evaluator.run(crops_csv_file=val_crops, crops_hdf_file="data_ready/val_128_128_32.hdf5",
                   workers=args.workers, batch_size=args.evalbatch, should_score=args.score, eval_file=None)
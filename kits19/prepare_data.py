@@ -4,6 +4,15 @@ import src.starter.utils as starter
 import pandas as pd
 import numpy as np
 import argparse
+import hashlib
+import multiprocessing
+from collections import deque
+from itertools import islice
+
+from src.boundary import spacing_from_affine
+from src.crop_index import load_crop_index, summed_volume, window_sums
+from src.h5layout import COMPRESSIONS, FORMAT_VERSION, case_ids, delete_case, file_format, mark_format, \
+    read_case_crops, read_spacing, write_case, write_case_crops
 
 DEFAULT_WIN_D = 64
 DEFAULT_WIN_H = 256
@@ -13,6 +22,9 @@ DEFAULT_STRIDE_D = 32
 DEFAULT_STRIDE_H = 128
 DEFAULT_STRIDE_W = 128
 
+# Voxels above this HU value count as body, the air around the patient is around -1000
+BODY_HU = -500
+
 def normalize(volume, min_val, max_val):
     im_volume = (volume - min_val) / max(max_val - min_val, 1e-3)
     return im_volume
@@ -35,6 +47,88 @@ def get_pad_size(imsize, cropsize):
 def halved_pads(pad_size):
     return (pad_size//2, pad_size//2 + pad_size%2)
 
+def process_case(row, min_val, max_val, window, stride, image_dtype=None, nifti_cache=None):
+    "Loads, normalizes, pads and crop-indexes a single case"
+    D_SIZE, H_SIZE, W_SIZE = window
+    case_id, z, x, y = row['case_id'], row['num_slices'], row['height'], row['width']
+    if nifti_cache is None:
+        im, mask = starter.load_case(case_id)
+        affine = im.affine
+        im, mask = im.get_data(), mask.get_data()
+    else:
+        im, mask, affine = starter.load_case_mmap(case_id, cache_dir=nifti_cache)
+#     print("Before padding:", im.shape)
+
+    z_pad_size = get_pad_size(im.shape[0], D_SIZE)
+    y_pad_size = get_pad_size(im.shape[1], H_SIZE)
+    x_pad_size = get_pad_size(im.shape[2], W_SIZE)
+
+    im = normalize(im, min_val, max_val)
+    im = np.pad(im, (halved_pads(z_pad_size),
+                     halved_pads(y_pad_size),
+                     halved_pads(x_pad_size)), 'constant')
+    mask = np.pad(mask, (halved_pads(z_pad_size),
+                         halved_pads(y_pad_size),
+                         halved_pads(x_pad_size)), 'constant')
+#     print("After padding:", im.shape)
+    case_positions = list(positions((int(z + z_pad_size), int(y + y_pad_size), int(x + x_pad_size)),
+                                    window, stride))
+    position_array = np.array(case_positions, dtype=np.int64).reshape(-1, 3)
+    kid_sizes = window_sums(summed_volume(mask, 1), position_array, window)
+    tumor_sizes = window_sums(summed_volume(mask, 2), position_array, window)
+    # Lets evaluation skip crops of air without running the network
+    body_sizes = window_sums(summed_volume(im > normalize(BODY_HU, min_val, max_val), True), position_array, window)
+    crops_data = [[case_id, position, window, stride, kid_size, tumor_size, body_size]
+                  for position, kid_size, tumor_size, body_size in zip(case_positions, kid_sizes, tumor_sizes,
+                                                                       body_sizes)]
+    if image_dtype is not None:
+        # Cast in the worker, so less data is sent back to the writer
+        im, mask = im.astype(image_dtype), mask.astype(np.uint8)
+    return case_id, im, mask, crops_data, spacing_from_affine(affine)
+
+
+def source_hash(case_id):
+    "SHA-1 of the case imaging and segmentation files"
+    digest = hashlib.sha1()
+    case_path = starter.get_case_path(case_id)
+    for name in ("imaging.nii.gz", "segmentation.nii.gz"):
+        with open(str(case_path / name), "rb") as f:
+            for block in iter(lambda: f.read(1 << 20), b""):
+                digest.update(block)
+    return digest.hexdigest()
+
+
+def source_hashes(case_ids, jobs=1):
+    if jobs <= 1:
+        return [source_hash(case_id) for case_id in case_ids]
+    with multiprocessing.Pool(jobs) as pool:
+        return pool.map(source_hash, case_ids)
+
+
+def is_up_to_date(stored_build, build):
+    return stored_build is not None and \
+        all(key in stored_build and np.array_equal(stored_build[key], value) for key, value in build.items())
+
+
+def processed_cases(rows, jobs=1, inflight=None, **kwargs):
+    """Yields process_case results in the order of `rows`.
+    With jobs > 1 cases run in a process pool and at most `inflight` of them are held at once"""
+    if jobs <= 1:
+        for row in rows:
+            yield process_case(row, **kwargs)
+        return
+    inflight = max(inflight or jobs, 1)
+    rows = iter(rows)
+    with multiprocessing.Pool(jobs) as pool:
+        pending = deque(pool.apply_async(process_case, (row,), kwargs) for row in islice(rows, inflight))
+        while pending:
+            result = pending.popleft().get()
+            # A slot is only released once the oldest case is handed to the writer
+            for row in islice(rows, 1):
+                pending.append(pool.apply_async(process_case, (row,), kwargs))
+            yield result
+
+
 def main():
     parser = argparse.ArgumentParser()
     
@@ -43,6 +137,19 @@ def main():
     parser.add_argument("--win_d", help="Window depth", type=int, default=DEFAULT_WIN_D)
     parser.add_argument("--stride_w", help="Stride width (and height)", type=int, default=DEFAULT_STRIDE_W)
     parser.add_argument("--stride_d", help="Stride depth", type=int, default=DEFAULT_STRIDE_D)
+    parser.add_argument("--layout", help="HDF5 layout version (1 - legacy float64 [image, mask])",
+                        type=int, default=FORMAT_VERSION)
+    parser.add_argument("--dtype", help="Image dtype for layout 2 (float16/float32)", type=str, default="float16")
+    parser.add_argument("--compression", help="Compression for layout 2", type=str, default="none",
+                        choices=COMPRESSIONS)
+    parser.add_argument("--jobs", help="Number of processes preparing cases", type=int, default=1)
+    parser.add_argument("--inflight", help="Max number of cases held in memory with --jobs (default: jobs)",
+                        type=int, default=None)
+    parser.add_argument("--incremental", help="Update an existing crops file: skip cases built from the same "
+                                              "source files and parameters, resume an interrupted build",
+                        action="store_true")
+    parser.add_argument("--nifti_cache", help="Read cases through an uncompressed memory-mapped cache "
+                                              "in this directory (filled on first use)", type=str, default=None)
     
     args = parser.parse_args()
     
@@ -61,44 +168,61 @@ def main():
     min_val = data['min_val'].quantile(0.01)
     
     data = pd.read_csv("{}_data_interpolated_stats.csv".format(args.stage))
-    cropsfile = h5py.File("data_ready/{}_{}_{}_{}.hdf5".format(args.stage, H_SIZE, W_SIZE, D_SIZE), "w")
+    cropsname = "data_ready/{}_{}_{}_{}.hdf5".format(args.stage, H_SIZE, W_SIZE, D_SIZE)
+    cropsfile = h5py.File(cropsname, "a" if args.incremental else "w")
+    if len(cropsfile) and file_format(cropsfile) != args.layout:
+        print("{} has a different layout, rebuilding it".format(cropsname))
+        cropsfile.close()
+        cropsfile = h5py.File(cropsname, "w")
+    mark_format(cropsfile, args.layout, WINDOW, STRIDE)
     cropscsv = "data_ready/{}_{}_{}_{}.csv".format(args.stage, H_SIZE, W_SIZE, D_SIZE)
-    
-    crops_data = []
-    for i in tqdm(range(len(data))):
-        row = data.iloc[i]
-        case_id, z, x, y = row['case_id'], row['num_slices'], row['height'], row['width']
-        im, mask = starter.load_case(case_id)
-        im, mask = im.get_data(), mask.get_data()
-    #     print("Before padding:", im.shape)
 
-        z_pad_size = get_pad_size(im.shape[0], D_SIZE)
-        y_pad_size = get_pad_size(im.shape[1], H_SIZE)
-        x_pad_size = get_pad_size(im.shape[2], W_SIZE)
+    case_list = list(data['case_id'])
+    for case_id in set(case_ids(cropsfile)) - set(case_list):
+        delete_case(cropsfile, case_id)
+    params = dict(min_val=min_val, max_val=max_val, window=WINDOW, stride=STRIDE, layout=args.layout,
+                  dtype=args.dtype, compression=args.compression, body_hu=BODY_HU)
+    # Hashing reads every source file once more, it's only needed to compare with a previous build.
+    # Cases built without a hash are rebuilt by the first --incremental run
+    if args.incremental:
+        builds = {case_id: dict(params, source_hash=source_hash)
+                  for case_id, source_hash in zip(case_list, source_hashes(case_list, args.jobs))}
+    else:
+        builds = {case_id: params for case_id in case_list}
+
+    case_crops = {}
+    for case_id in case_list:
+        crops, stored_build = read_case_crops(cropsfile, case_id)
+        # Cases written before the voxel spacing was stored are rebuilt too
+        if is_up_to_date(stored_build, builds[case_id]) and read_spacing(cropsfile[case_id]) is not None:
+            case_crops[case_id] = [[case_id, (z, y, x), WINDOW, STRIDE, kid_size, tumor_size, body_size]
+                                   for z, y, x, kid_size, tumor_size, body_size in crops.tolist()]
+    if case_crops:
+        print("{} of {} cases are up to date".format(len(case_crops), len(case_list)))
 
-        im = normalize(im, min_val, max_val)
-        im = np.pad(im, (halved_pads(z_pad_size),
-                         halved_pads(y_pad_size),
-                         halved_pads(x_pad_size)), 'constant')
-        mask = np.pad(mask, (halved_pads(z_pad_size),
-                             halved_pads(y_pad_size),
-                             halved_pads(x_pad_size)), 'constant')
-    #     print("After padding:", im.shape)
-        for position in positions((int(z + z_pad_size), int(y + y_pad_size), int(x + x_pad_size)),
-                                  WINDOW, STRIDE):
-            z, y, x = position
-            cropped_mask = mask[z:z+D_SIZE, y:y+H_SIZE, x:x+W_SIZE]
-            kid_size = np.sum(cropped_mask == 1)
-            tumor_size = np.sum(cropped_mask == 2)
-            crops_data.append([case_id, position, WINDOW, STRIDE, kid_size, tumor_size])
-        cropsfile.create_dataset(case_id, data=np.array([im, mask]))
+    rows = (data.iloc[i] for i in range(len(data)) if data.iloc[i]['case_id'] not in case_crops)
+    cases = processed_cases(rows, jobs=args.jobs, inflight=args.inflight,
+                            min_val=min_val, max_val=max_val, window=WINDOW, stride=STRIDE,
+                            image_dtype=args.dtype if args.layout > 1 else None, nifti_cache=args.nifti_cache)
+    for case_id, im, mask, crops, spacing in tqdm(cases, total=len(case_list) - len(case_crops)):
+        case_crops[case_id] = crops
+        write_case(cropsfile, case_id, im, mask, version=args.layout, window=WINDOW, stride=STRIDE,
+                   image_dtype=args.dtype, compression=args.compression, spacing=spacing)
+        write_case_crops(cropsfile, case_id, [[*position, kid_size, tumor_size, body_size]
+                                              for _, position, _, _, kid_size, tumor_size, body_size in crops],
+                         builds[case_id])
+        # Leave completed cases on disk, so an interrupted build can be resumed with --incremental
+        cropsfile.flush()
 
+    crops_data = [crop for case_id in case_list for crop in case_crops[case_id]]
     cropsfile.close()
 
     crops_data = pd.DataFrame(data=crops_data,
                               columns=["case_id", "position", "window_size",
-                                       "stride", "kid_size", "tumor_size"])
+                                       "stride", "kid_size", "tumor_size", "body_size"])
     crops_data.to_csv(cropscsv)
+    # Compiles the crop index sidecar, so loading it with cache=True doesn't parse the CSV
+    load_crop_index(cropscsv, cache=True)
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
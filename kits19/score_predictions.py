@@ -0,0 +1,33 @@
+import argparse
+
+import numpy as np
+import pandas as pd
+
+from src.score import class_metrics, score_from_counts, score_prediction_file
+
+parser = argparse.ArgumentParser()
+parser.add_argument("--file", help="Predictions file written by main_evaluation", type=str,
+                    default="val_predictions.hdf5")
+parser.add_argument("--crops", help="Crops file holding the ground truth masks", type=str,
+                    default="val_interpolated_crops.hdf5")
+parser.add_argument("--slab", help="Slices read at once", type=int, default=16)
+parser.add_argument("--output", help="Per-case metrics csv", type=str, default=None)
+args = parser.parse_args()
+
+results = score_prediction_file(args.file, args.crops, slab=args.slab)
+rows = []
+for case, (score, counts) in results.items():
+    metrics = class_metrics(counts)
+    row = dict(case_id=case, score=score)
+    for name, index in (("kidney", 1), ("tumor", 2)):
+        for metric in ("dice", "iou", "precision", "recall"):
+            row["{}_{}".format(name, metric)] = metrics[metric][index]
+    rows.append(row)
+    print("{}: {:.4f}".format(case, score))
+
+if results:
+    total = sum(counts for _, counts in results.values())
+    print("Mean case score: {:.4f}".format(np.mean([score for score, _ in results.values()])))
+    print("Pooled score: {:.4f}".format(score_from_counts(total)))
+if args.output is not None:
+    pd.DataFrame(rows).to_csv(args.output, index=False)
@@ -0,0 +1,127 @@
+import multiprocessing
+
+import numpy as np
+from scipy import ndimage
+
+BOUNDARY_METRICS = ['hd95', 'assd']
+
+
+def spacing_from_affine(affine):
+    "Voxel size along each array axis: the lengths of the affine's direction columns"
+    return np.linalg.norm(np.asarray(affine, dtype=np.float64)[:3, :3], axis=0)
+
+
+def surface(mask):
+    "Voxels of a binary mask with a 6-connected neighbour outside of it"
+    return mask & ~ndimage.binary_erosion(mask, structure=ndimage.generate_binary_structure(3, 1))
+
+
+def surface_distances(prediction, ground_truth, spacing):
+    """Distances in mm from every surface voxel of each binary mask to the surface of the other.
+    Both masks hold all voxels of their structures, so the distance transforms over such a crop
+    are the same as over the whole volume"""
+    prediction_surface, ground_truth_surface = surface(prediction), surface(ground_truth)
+    to_ground_truth = ndimage.distance_transform_edt(~ground_truth_surface, sampling=spacing)[prediction_surface]
+    to_prediction = ndimage.distance_transform_edt(~prediction_surface, sampling=spacing)[ground_truth_surface]
+    return to_ground_truth, to_prediction
+
+
+def binary_boundary_metrics(prediction, ground_truth, spacing):
+    """(hd95, assd) of two binary masks: the larger of the two directed 95th percentile surface distances
+    and the mean surface distance over both surfaces. NaN if both masks are empty, inf if one is"""
+    has_prediction, has_ground_truth = prediction.any(), ground_truth.any()
+    if not has_prediction and not has_ground_truth:
+        return np.nan, np.nan
+    if not has_prediction or not has_ground_truth:
+        return np.inf, np.inf
+    to_ground_truth, to_prediction = surface_distances(prediction, ground_truth, spacing)
+    hd95 = max(np.percentile(to_ground_truth, 95), np.percentile(to_prediction, 95))
+    assd = (to_ground_truth.sum() + to_prediction.sum()) / (len(to_ground_truth) + len(to_prediction))
+    return float(hd95), float(assd)
+
+
+def merge_boxes(first, second, shape, margin=1):
+    "Smallest box holding both find_objects boxes (either may be None), grown by `margin` voxels"
+    boxes = [box for box in (first, second) if box is not None]
+    if not boxes:
+        return None
+    return tuple(slice(max(min(box[axis].start for box in boxes) - margin, 0),
+                       min(max(box[axis].stop for box in boxes) + margin, shape[axis]))
+                 for axis in range(len(shape)))
+
+
+def class_tasks(prediction, ground_truth, spacing, n_classes=3):
+    """(class, (prediction crop, ground truth crop, spacing)) for every foreground class. Each class is
+    cropped to the box around it in either volume, found for all classes in one find_objects pass"""
+    prediction = np.asarray(prediction).reshape(np.shape(ground_truth))
+    ground_truth = np.asarray(ground_truth)
+    prediction_boxes = ndimage.find_objects(prediction.astype(np.int32, copy=False), n_classes - 1)
+    ground_truth_boxes = ndimage.find_objects(ground_truth.astype(np.int32, copy=False), n_classes - 1)
+    spacing = tuple(float(s) for s in spacing)
+    tasks = []
+    for target in range(1, n_classes):
+        box = merge_boxes(prediction_boxes[target - 1], ground_truth_boxes[target - 1], ground_truth.shape)
+        if box is None:
+            box = (slice(0, 0),) * ground_truth.ndim
+        tasks.append((target, (prediction[box] == target, ground_truth[box] == target, spacing)))
+    return tasks
+
+
+def empty_metrics(n_classes=3):
+    return {name: np.full(n_classes, np.nan) for name in BOUNDARY_METRICS}
+
+
+def boundary_metrics(prediction, ground_truth, spacing, n_classes=3):
+    """Per-class hd95 and assd in mm, as arrays indexed by class like score.class_metrics.
+    The background entry is NaN"""
+    metrics = empty_metrics(n_classes)
+    for target, task in class_tasks(prediction, ground_truth, spacing, n_classes):
+        metrics['hd95'][target], metrics['assd'][target] = binary_boundary_metrics(*task)
+    return metrics
+
+
+class BoundaryScorer:
+    """Computes boundary metrics of many cases, one task per case and class in a pool of `jobs` processes.
+
+    `submit` only crops the classes and hands them to the pool, so it returns quickly; `results`
+    waits for all cases. With jobs <= 1 the metrics are computed in `submit`.
+    """
+
+    def __init__(self, jobs=1, n_classes=3):
+        self.n_classes = n_classes
+        self.pool = multiprocessing.Pool(jobs) if jobs > 1 else None
+        self.pending = {}
+
+    def submit(self, case, prediction, ground_truth, spacing):
+        tasks = class_tasks(prediction, ground_truth, spacing, self.n_classes)
+        if self.pool is None:
+            self.pending[case] = [(target, binary_boundary_metrics(*task)) for target, task in tasks]
+        else:
+            self.pending[case] = [(target, self.pool.apply_async(binary_boundary_metrics, task))
+                                  for target, task in tasks]
+
+    def results(self):
+        "case -> per-class metrics, in submission order"
+        results = {}
+        for case, classes in self.pending.items():
+            metrics = empty_metrics(self.n_classes)
+            for target, values in classes:
+                if self.pool is not None:
+                    values = values.get()
+                metrics['hd95'][target], metrics['assd'][target] = values
+            results[case] = metrics
+        return results
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        if self.pool is not None:
+            self.pool.terminate()
+            self.pool = None
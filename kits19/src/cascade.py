@@ -0,0 +1,109 @@
+import numpy as np
+import torch
+import torch.nn.functional as F
+from scipy import ndimage
+
+from src.inference import SlidingWindowInference
+from src.precision import autocast
+
+
+def window_grid(size, window, stride):
+    "Window starts covering 0..size, the last one aligned with the end"
+    starts = list(range(0, max(size - window, 0) + 1, stride))
+    if starts[-1] + window < size:
+        starts.append(size - window)
+    return starts
+
+
+def intersecting(positions, window, boxes):
+    "Mask of the (N, 3) window positions that overlap any of the ((z0, z1), (y0, y1), (x0, x1)) boxes"
+    positions = np.asarray(positions).reshape(-1, 3)
+    keep = np.zeros(len(positions), dtype=bool)
+    for box in boxes:
+        inside = np.ones(len(positions), dtype=bool)
+        for axis, (start, stop) in enumerate(box):
+            inside &= (positions[:, axis] < stop) & (positions[:, axis] + window[axis] > start)
+        keep |= inside
+    return keep
+
+
+class CoarseLocalizer:
+    """First stage of the coarse-to-fine cascade.
+
+    Every case is downsampled by `scale` and segmented with a sliding window of `window` (by default
+    the window of the case's crops), then the
+    connected components of the `labels` with at least `min_voxels` downsampled voxels give boxes, grown
+    by `margin` full resolution voxels.
+    As a crop filter of Evaluator.run it keeps the full resolution crops that touch a box. Cases where
+    no box is found keep all their crops (counted in `fallbacks`), a missed kidney would otherwise
+    turn the whole case into background.
+    `net` can be the full resolution network itself, but it was trained on full resolution crops;
+    a net trained on downsampled volumes makes the boxes more reliable.
+    """
+
+    name = 'cascade'
+
+    def __init__(self, net, window=None, scale=(0.5, 0.25, 0.25), margin=(8, 32, 32), labels=(1, 2), min_voxels=27,
+                 device='cpu', precision='fp32', batch_size=1):
+        self.net = net
+        self.window = None if window is None else tuple(int(w) for w in window)
+        self.scale = tuple(scale)
+        self.margin = tuple(margin)
+        self.labels = labels
+        self.min_voxels = min_voxels
+        self.device = device
+        self.precision = precision
+        self.batch_size = batch_size
+        self.boxes = {}
+        self.fallbacks = 0
+
+    def segment(self, image, window):
+        "Labels of the downsampled image"
+        volume = torch.from_numpy(np.asarray(image, dtype=np.float32))[None, None].to(self.device)
+        volume = F.interpolate(volume, scale_factor=self.scale, mode='trilinear', align_corners=False)[0, 0]
+        shape = volume.shape
+        # The window may be larger than the downsampled volume
+        volume = F.pad(volume, [pad for size, win in reversed(list(zip(shape, window)))
+                                for pad in (0, max(win - size, 0))])
+        grid = [window_grid(size, win, max(win // 2, 1)) for size, win in zip(volume.shape, window)]
+        positions = np.array(np.meshgrid(*grid, indexing='ij')).reshape(3, -1).T
+        inference = SlidingWindowInference(window, device=self.device)
+        result = inference.volume(volume.shape)
+        zw, yw, xw = window
+        with torch.no_grad():
+            for start in range(0, len(positions), self.batch_size):
+                batch = positions[start:start + self.batch_size]
+                crops = torch.stack([volume[z:z + zw, y:y + yw, x:x + xw] for z, y, x in batch])[:, None]
+                with autocast(self.precision, self.device):
+                    predict = self.net(crops)
+                inference.add(result, batch, predict)
+        result = inference.finalize(result, positions)
+        return torch.argmax(result, 0)[:shape[0], :shape[1], :shape[2]].cpu().numpy()
+
+    def case_boxes(self, image, window):
+        "Full resolution ((z0, z1), (y0, y1), (x0, x1)) boxes of the foreground components"
+        labels = self.segment(image, self.window or window)
+        components, count = ndimage.label(np.isin(labels, self.labels))
+        sizes = np.bincount(components.ravel(), minlength=count + 1)
+        boxes = []
+        for number, box in enumerate(ndimage.find_objects(components), 1):
+            if sizes[number] < self.min_voxels:
+                continue
+            boxes.append(tuple((max(int(np.floor(part.start / scale)) - margin, 0),
+                                min(int(np.ceil(part.stop / scale)) + margin, size))
+                               for part, scale, margin, size in zip(box, self.scale, self.margin, image.shape)))
+        return boxes
+
+    def keep(self, dataset):
+        keep = np.zeros(len(dataset.crops), dtype=bool)
+        self.fallbacks = 0
+        for number, case in enumerate(dataset.cases):
+            window = dataset.case_window(number)
+            self.boxes[case] = self.case_boxes(dataset.case_image(number), window)
+            start, stop = dataset.case_starts[number], dataset.case_starts[number + 1]
+            if not self.boxes[case]:
+                self.fallbacks += 1
+                keep[start:stop] = True
+                continue
+            keep[start:stop] = intersecting(dataset.case_positions(number), window, self.boxes[case])
+        return keep
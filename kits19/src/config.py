@@ -6,5 +6,7 @@ config = {
     'L2': 0,
     'DEBUG': False,
     'CUDA': torch.cuda.is_available(),
-    'DEVICE': torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    'DEVICE': torch.device("cuda" if torch.cuda.is_available() else "cpu"),
+    # fp32 / fp16 / bf16 (see src.precision); reduced precisions run as bf16 on CPU
+    'PRECISION': "fp32"
 }
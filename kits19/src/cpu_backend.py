@@ -0,0 +1,103 @@
+import copy
+
+import numpy as np
+import torch
+import torch.nn as nn
+from torch.ao.quantization import DeQuantStub, QuantStub, convert, get_default_qconfig, prepare
+
+from src.crop_index import load_crop_index
+from src.data import H5Dataset
+from src.export import fold_batchnorm
+
+# eager - fp32 NCDHW, channels_last - fp32 in the channels_last_3d memory format,
+# int8 - Conv3d layers statically quantized, calibrated on a few crops
+CPU_BACKENDS = ['eager', 'channels_last', 'int8']
+
+
+def quantized_engine():
+    engines = torch.backends.quantized.supported_engines
+    return 'x86' if 'x86' in engines else 'fbgemm'
+
+
+class ChannelsLast(nn.Module):
+    "Runs a network converted to channels_last_3d on inputs in the same memory format"
+
+    def __init__(self, net):
+        super(ChannelsLast, self).__init__()
+        self.net = net.to(memory_format=torch.channels_last_3d)
+
+    def forward(self, x):
+        return self.net(x.contiguous(memory_format=torch.channels_last_3d))
+
+
+class QuantizedConv3d(nn.Module):
+    """A Conv3d between a quantize and a dequantize step. Only the convolutions run in int8, so no other
+    layer of the networks has to support quantized tensors, and nothing needs to be traced"""
+
+    def __init__(self, conv, qconfig):
+        super(QuantizedConv3d, self).__init__()
+        self.quant = QuantStub()
+        self.conv = conv
+        self.dequant = DeQuantStub()
+        self.qconfig = qconfig
+
+    def forward(self, x):
+        return self.dequant(self.conv(self.quant(x)))
+
+
+def wrap_convs(module, qconfig):
+    for name, child in module.named_children():
+        if isinstance(child, nn.Conv3d):
+            setattr(module, name, QuantizedConv3d(child, qconfig))
+        else:
+            wrap_convs(child, qconfig)
+
+
+def quantize_convs(net, calibration):
+    """Copy of an eval-mode net with BatchNorm folded and every Conv3d quantized to int8.
+    Activation ranges are observed on the `calibration` batches"""
+    engine = quantized_engine()
+    torch.backends.quantized.engine = engine
+    net = copy.deepcopy(net).eval()
+    fold_batchnorm(net)
+    wrap_convs(net, get_default_qconfig(engine))
+    prepare(net, inplace=True)
+    with torch.no_grad():
+        for batch in calibration:
+            net(batch)
+    return convert(net, inplace=True)
+
+
+def calibration_crops(hdf_file, csv_file, count=8, seed=0):
+    """(1, 1, *window) image crops for calibration. Half of them are taken from crops with kidney,
+    so the observed ranges cover the foreground and not only the background"""
+    crops = load_crop_index(csv_file)
+    rng = np.random.RandomState(seed)
+    kidney = np.flatnonzero(crops.kid_size > 0)
+    other = np.flatnonzero(crops.kid_size == 0)
+    n_kidney = min(len(kidney), count // 2)
+    chosen = np.concatenate([rng.choice(kidney, n_kidney, replace=False),
+                             rng.choice(other, min(len(other), count - n_kidney), replace=False)])
+    dataset = H5Dataset(hdf_file)
+    batches = []
+    for index in chosen:
+        case_id, position, window = crops[index]
+        image, _ = dataset.read_crop(case_id, position, window)
+        batches.append(torch.from_numpy(np.asarray(image, dtype=np.float32))[None, None])
+    dataset.close()
+    return batches
+
+
+def cpu_backend(net, backend, calibration=None):
+    """An eval-mode net prepared for CPU inference with `backend`; int8 needs calibration batches.
+    Backends other than eager work on a copy, so `net` itself keeps its layout and weights"""
+    if backend not in CPU_BACKENDS:
+        raise ValueError("Unknown CPU backend '{}'. Must be one of {}".format(backend, CPU_BACKENDS))
+    net = net.cpu().eval()
+    if backend == 'channels_last':
+        return ChannelsLast(copy.deepcopy(net))
+    if backend == 'int8':
+        if not calibration:
+            raise ValueError("The int8 backend needs calibration crops")
+        return quantize_convs(net, calibration)
+    return net
@@ -0,0 +1,153 @@
+import os
+
+import numpy as np
+import pandas as pd
+
+CROP_DTYPE = np.dtype([('case', np.int32),
+                       ('z', np.int32), ('y', np.int32), ('x', np.int32),
+                       ('zw', np.int32), ('yw', np.int32), ('xw', np.int32),
+                       ('kid_size', np.int64), ('tumor_size', np.int64),
+                       # Voxels above prepare_data.BODY_HU, -1 for crops files written before it was stored
+                       ('body_size', np.int64)])
+
+
+class CropIndex:
+    """Crops table compiled into a structured array.
+
+    `crops['case']` is a code into `cases`, the case names in order of first appearance
+    in the CSV. Looking a crop up is plain integer indexing, nothing is parsed per sample.
+    """
+
+    def __init__(self, crops, cases):
+        self.crops = crops
+        self.cases = cases
+
+    def __len__(self):
+        return len(self.crops)
+
+    def __getitem__(self, idx):
+        "Returns (case_id, (z, y, x), (zw, yw, xw)) of a crop"
+        case, z, y, x, zw, yw, xw = self.crops[idx].tolist()[:7]
+        return str(self.cases[case]), (z, y, x), (zw, yw, xw)
+
+    @property
+    def kid_size(self):
+        return self.crops['kid_size']
+
+    @property
+    def tumor_size(self):
+        return self.crops['tumor_size']
+
+    @property
+    def body_size(self):
+        return self.crops['body_size']
+
+    @property
+    def positions(self):
+        return np.stack([self.crops['z'], self.crops['y'], self.crops['x']], axis=1)
+
+    @property
+    def windows(self):
+        return np.stack([self.crops['zw'], self.crops['yw'], self.crops['xw']], axis=1)
+
+    def case_code(self, case_id):
+        codes = np.flatnonzero(self.cases == case_id)
+        if not len(codes):
+            raise KeyError("Case {} is not in the crop index".format(case_id))
+        return int(codes[0])
+
+    def select(self, selection):
+        "Sub-index by boolean mask or integer indices; the case table is shared"
+        return CropIndex(self.crops[selection], self.cases)
+
+    def for_case(self, case_id):
+        return self.select(self.crops['case'] == self.case_code(case_id))
+
+    @classmethod
+    def from_csv(cls, csvfile):
+        frame = pd.read_csv(csvfile)
+        codes, cases = pd.factorize(frame.case_id, sort=False)
+        crops = np.zeros(len(frame), dtype=CROP_DTYPE)
+        crops['case'] = codes
+        crops['z'], crops['y'], crops['x'] = _parse_triples(frame.position)
+        if 'window_size' in frame.columns:
+            crops['zw'], crops['yw'], crops['xw'] = _parse_triples(frame.window_size)
+        else:
+            # Crops from h5_data_preparation.ipynb store a single cubic window size
+            crops['zw'] = crops['yw'] = crops['xw'] = frame.window.values
+        crops['kid_size'] = frame.kid_size.values
+        crops['tumor_size'] = frame.tumor_size.values
+        crops['body_size'] = frame.body_size.values if 'body_size' in frame.columns else -1
+        return cls(crops, np.asarray(cases, dtype=str))
+
+    def save(self, filename):
+        "Writes a self-contained .npy with case names inlined, so no pickling is needed"
+        width = max(len(case) for case in self.cases) if len(self.cases) else 1
+        dtype = np.dtype([('case_id', 'U{}'.format(width))] + CROP_DTYPE.descr[1:])
+        stored = np.zeros(len(self.crops), dtype=dtype)
+        stored['case_id'] = self.cases[self.crops['case']]
+        for name in CROP_DTYPE.names[1:]:
+            stored[name] = self.crops[name]
+        np.save(filename, stored)
+
+    @classmethod
+    def load(cls, filename):
+        stored = np.load(filename)
+        codes, cases = pd.factorize(stored['case_id'], sort=False)
+        crops = np.zeros(len(stored), dtype=CROP_DTYPE)
+        crops['case'] = codes
+        for name in CROP_DTYPE.names[1:]:
+            crops[name] = stored[name] if name in stored.dtype.names else -1
+        return cls(crops, np.asarray(cases, dtype=str))
+
+
+def summed_volume(mask, label):
+    "3D summed-volume table of (mask == label), with a zero plane in front of every axis"
+    dtype = np.int32 if mask.size < 2 ** 31 else np.int64
+    table = np.zeros([s + 1 for s in mask.shape], dtype=dtype)
+    inner = table[1:, 1:, 1:]
+    np.cumsum(mask == label, axis=0, dtype=dtype, out=inner)
+    np.cumsum(inner, axis=1, out=inner)
+    np.cumsum(inner, axis=2, out=inner)
+    return table
+
+def window_sums(table, positions, window):
+    "Sums over windows starting at each of the (N, 3) positions, 8 table lookups per window"
+    # Clipped like mask[z:z+D, y:y+H, x:x+W] would be at the volume border
+    limits = np.array(table.shape) - 1
+    z0, y0, x0 = np.minimum(positions, limits).T
+    z1, y1, x1 = np.minimum(positions + np.array(window), limits).T
+    sums = (table[z1, y1, x1] - table[z0, y1, x1] - table[z1, y0, x1] - table[z1, y1, x0]
+            + table[z0, y0, x1] + table[z0, y1, x0] + table[z1, y0, x0] - table[z0, y0, x0])
+    return sums.astype(np.int64)
+
+
+def _parse_triples(column):
+    "'(z, y, x)' strings -> three int arrays"
+    parts = column.str.strip("()").str.split(",", expand=True).astype(np.int64)
+    return parts[0].values, parts[1].values, parts[2].values
+
+
+def index_cache_file(csvfile):
+    return csvfile + ".npy"
+
+
+def load_crop_index(csv, cache=False):
+    """Crop index for a crops CSV from prepare_data.py.
+
+    With `cache` the compiled index is kept in a `<csv>.npy` sidecar and reused while it
+    is newer than the CSV; prepare_data.py writes the sidecar with the CSV. An already built
+    CropIndex is passed through.
+    """
+    if isinstance(csv, CropIndex):
+        return csv
+    sidecar = index_cache_file(csv)
+    if cache and os.path.exists(sidecar) and os.path.getmtime(sidecar) >= os.path.getmtime(csv):
+        return CropIndex.load(sidecar)
+    index = CropIndex.from_csv(csv)
+    if cache:
+        try:
+            index.save(sidecar)
+        except OSError as e:
+            print("Could not write crop index cache {}: {}".format(sidecar, e))
+    return index
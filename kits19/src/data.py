@@ -1,55 +1,288 @@
+import multiprocessing.util
+import os
+from collections import OrderedDict, deque
+
 import torch
 import torch.utils.data
-import pandas as pd
+import numpy as np
 import h5py
 
+from src.crop_index import load_crop_index
+from src.h5layout import file_format, read_case, read_crop
+
+
+# Order of the CaseCache counters
+CACHE_COUNTERS = ('hits', 'misses', 'evictions')
+
+
+class CaseCache:
+    """LRU cache of decoded cases bounded by `max_bytes`, with hit/miss/eviction counters.
+    `counts` holds the counters in CACHE_COUNTERS order; it may be a view of shared memory"""
+
+    def __init__(self, max_bytes, counts=None):
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.bytes = 0
+        self.counts = np.zeros(len(CACHE_COUNTERS), dtype=np.int64) if counts is None else counts
+
+    @property
+    def hits(self):
+        return int(self.counts[0])
+
+    @property
+    def misses(self):
+        return int(self.counts[1])
+
+    @property
+    def evictions(self):
+        return int(self.counts[2])
+
+    def get(self, key, load):
+        entry = self.entries.get(key)
+        if entry is not None:
+            self.counts[0] += 1
+            self.entries.move_to_end(key)
+            return entry
+        self.counts[1] += 1
+        entry = load()
+        size = sum(array.nbytes for array in entry)
+        if size > self.max_bytes:
+            # Never fits, don't flush the cache for it
+            return entry
+        while self.bytes + size > self.max_bytes:
+            _, evicted = self.entries.popitem(last=False)
+            self.bytes -= sum(array.nbytes for array in evicted)
+            self.counts[2] += 1
+        self.entries[key] = entry
+        self.bytes += size
+        return entry
+
+    def clear(self):
+        self.entries.clear()
+        self.bytes = 0
+
+    def stats(self):
+        return dict(hits=self.hits, misses=self.misses, evictions=self.evictions,
+                    cases=len(self.entries), bytes=self.bytes)
 
-class H5CropData(torch.utils.data.Dataset):
-    def __init__(self, filename, csv):
+    def __getstate__(self):
+        # Workers started with spawn get an empty cache instead of a pickled copy of the data
+        state = self.__dict__.copy()
+        state['entries'] = OrderedDict()
+        state['bytes'] = 0
+        return state
+
+
+class H5Dataset(torch.utils.data.Dataset):
+    """Base dataset over a crops HDF5 file.
+
+    The file is opened lazily once per process and dataset handles are cached per case_id,
+    so crops are read without reopening the file. A handle inherited through fork is never
+    reused: it is reopened in the worker by `h5_worker_init` (or on first access if the
+    loader was built without it). Both on-disk layouts of src/h5layout.py are read.
+
+    With `cache_bytes` whole cases are decoded once and kept in a per-process CaseCache,
+    crops are then sliced from memory; pair it with CaseGroupedBatchSampler so the cache hits.
+    The caches of loader workers count into shared memory after `share_cache_stats`, the main
+    process reads the totals with `cache_stats`.
+    """
+
+    def __init__(self, filename, cache_bytes=0):
         self.filename = filename
-        self.crops = pd.read_csv(csv)
-        self.crops = self.crops[self.crops.kid_size > 0]
-        # self.crops = self.crops[(self.crops.kid_size > 0) & (self.crops.case_id == 'case_00130')]
+        self._file = None
+        self._pid = None
+        self._cases = {}
+        self.format = None
+        self.cache = CaseCache(cache_bytes) if cache_bytes > 0 else None
+        self.cache_counters = None
+
+    @property
+    def file(self):
+        if self._file is None or self._pid != os.getpid():
+            self.reopen()
+        return self._file
+
+    def case_dataset(self, case_id):
+        dataset = self._cases.get(case_id)
+        if dataset is None or self._pid != os.getpid():
+            dataset = self.file[case_id]
+            self._cases[case_id] = dataset
+        return dataset
+
+    def read_crop(self, case_id, position, window):
+        if self.cache is not None:
+            im, mask = self.cache.get(case_id, lambda: read_case(self.case_dataset(case_id), self.format))
+            (z, y, x), (zw, yw, xw) = position, window
+            return im[z:z + zw, y:y + yw, x:x + xw], mask[z:z + zw, y:y + yw, x:x + xw]
+        dataset = self.case_dataset(case_id)
+        return read_crop(dataset, self.format, position, window)
+
+    def share_cache_stats(self, workers):
+        """Keeps the cache counters of this process and of `workers` loader workers in shared memory.
+        Call before the DataLoader starts its workers"""
+        self.cache_counters = torch.zeros((workers + 1, len(CACHE_COUNTERS)), dtype=torch.int64).share_memory_()
+        if self.cache is not None:
+            self.cache.counts = self.cache_counters[0].numpy()
+
+    def worker_cache_counts(self, worker_id):
+        "Points the cache of a loader worker at its row of the shared counters"
+        if self.cache is not None and self.cache_counters is not None:
+            self.cache.counts = self.cache_counters[worker_id + 1].numpy()
+
+    def cache_stats(self):
+        """Counters of all processes summed since `share_cache_stats` or the last call, which resets them.
+        Read them when no worker is running, e.g. after an epoch"""
+        if self.cache_counters is None:
+            return None
+        totals = self.cache_counters.sum(0).tolist()
+        self.cache_counters.zero_()
+        return dict(zip(CACHE_COUNTERS, totals))
+
+    def reopen(self):
+        if self._pid == os.getpid():
+            self.close()
+        else:
+            # Handles inherited from the parent process belong to its HDF5 state, drop them
+            self._file = None
+            self._cases = {}
+        self._file = h5py.File(self.filename, "r")
+        self._pid = os.getpid()
+        self.format = file_format(self._file)
+
+    def close(self):
+        self._cases = {}
+        if self._file is not None and self._pid == os.getpid():
+            self._file.close()
+        self._file = None
+        self._pid = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_file'] = None
+        state['_pid'] = None
+        state['_cases'] = {}
+        return state
+
+    def __del__(self):
+        try:
+            self.close()
+        except Exception:
+            pass
+
+
+def h5_worker_init(worker_id):
+    "DataLoader worker_init_fn: gives each worker its own HDF5 handle, closed when the worker exits"
+    dataset = torch.utils.data.get_worker_info().dataset
+    if isinstance(dataset, H5Dataset):
+        dataset.reopen()
+        dataset.worker_cache_counts(worker_id)
+        multiprocessing.util.Finalize(dataset, dataset.close, exitpriority=10)
+
+
+class CaseGroupedSampler(torch.utils.data.Sampler):
+    """Shuffles crops of an H5Dataset within buckets of `bucket_cases` cases and shuffles the
+    bucket order, so consecutive crops come from the same cases and a CaseCache hits.
+
+    It generates the buckets of CaseGroupedBatchSampler. As the `sampler` of a DataLoader it only keeps
+    the caches hit without workers: with workers the batches of a bucket are dealt out to all of them
+    and every worker decodes every case; use CaseGroupedBatchSampler there.
+    """
+
+    def __init__(self, dataset, bucket_cases=1):
+        self.cases = dataset.crops.crops['case']
+        self.bucket_cases = bucket_cases
+
+    def __len__(self):
+        return len(self.cases)
+
+    def buckets(self):
+        "Shuffled crop indices of every bucket, in a shuffled bucket order"
+        codes = np.unique(self.cases)
+        np.random.shuffle(codes)
+        for start in range(0, len(codes), self.bucket_cases):
+            bucket = np.flatnonzero(np.isin(self.cases, codes[start:start + self.bucket_cases]))
+            np.random.shuffle(bucket)
+            yield bucket
+
+    def __iter__(self):
+        for bucket in self.buckets():
+            yield from bucket.tolist()
+
+
+class CaseGroupedBatchSampler(torch.utils.data.Sampler):
+    """Batches of CaseGroupedSampler buckets for a DataLoader with `workers` worker processes.
+
+    The DataLoader hands batch i to worker i % workers. The buckets are split into one stream per worker,
+    each bucket going to the stream with the fewest crops, and the batches of the streams are interleaved.
+    So all crops of a case go to one worker and the case is decoded into a single worker's CaseCache.
+    A worker whose stream ran out takes batches from the end of the longest one, only those cases are
+    decoded twice.
+    Batches don't mix streams, so up to `workers` of them are smaller than `batch_size`.
+    """
+
+    def __init__(self, dataset, batch_size, workers=0, bucket_cases=1):
+        self.sampler = CaseGroupedSampler(dataset, bucket_cases)
+        self.batch_size = batch_size
+        self.workers = max(workers, 1)
+        # The batch count depends on the split, so the next epoch is planned ahead for __len__
+        self.plan = self.plan_epoch()
+
+    def plan_epoch(self):
+        streams = [[] for _ in range(self.workers)]
+        for bucket in self.sampler.buckets():
+            min(streams, key=len).extend(bucket.tolist())
+        queues = [deque(stream[start:start + self.batch_size] for start in range(0, len(stream), self.batch_size))
+                  for stream in streams]
+        plan = []
+        for turn in range(sum(len(queue) for queue in queues)):
+            queue = queues[turn % self.workers]
+            if queue:
+                plan.append(queue.popleft())
+            else:
+                # This worker's stream ran out, it takes the batch its owner would read last
+                plan.append(max(queues, key=len).pop())
+        return plan
+
+    def __len__(self):
+        return len(self.plan)
+
+    def __iter__(self):
+        plan, self.plan = self.plan, self.plan_epoch()
+        return iter(plan)
+
+
+class H5CropData(H5Dataset):
+    def __init__(self, filename, csv, cache_bytes=0):
+        super(H5CropData, self).__init__(filename, cache_bytes=cache_bytes)
+        self.crops = load_crop_index(csv)
+        self.crops = self.crops.select(self.crops.kid_size > 0)
+        # self.crops = self.crops.for_case('case_00130')
 
     def __len__(self):
         return len(self.crops)
 
     def __getitem__(self, idx):
-        row = self.crops.iloc[idx]
-        case_id = row.case_id
-        z, x, y = eval(row.position)
-        window = row.window
-        self.file = h5py.File(self.filename, "r")
-        dat = self.file[case_id][:, z:z + window, x:x + window, y:y + window]
-        self.file.close()
-        im = dat[0, :, :, :]
-        mask = dat[1, :, :, :]
+        case_id, position, window = self.crops[idx]
+        im, mask = self.read_crop(case_id, position, window)
         return torch.from_numpy(im).unsqueeze(0).float(), torch.from_numpy(mask).long()
 
 
-class H5CropData2(torch.utils.data.Dataset):
-    def __init__(self, hdf5file, csvfile):
-        self.filename = hdf5file
-        crops = pd.read_csv(csvfile)
-        non_empty = crops[crops.kid_size > 0]
-        empty = crops[crops.kid_size == 0]
-        empty = empty.sample(int(len(non_empty) * 0.2))
-        self.crops = pd.concat([non_empty, empty])
+class H5CropData2(H5Dataset):
+    def __init__(self, hdf5file, csvfile, cache_bytes=0):
+        super(H5CropData2, self).__init__(hdf5file, cache_bytes=cache_bytes)
+        crops = load_crop_index(csvfile)
+        non_empty = np.flatnonzero(crops.kid_size > 0)
+        empty = np.flatnonzero(crops.kid_size == 0)
+        empty = np.random.choice(empty, int(len(non_empty) * 0.2), replace=False)
+        self.crops = crops.select(np.concatenate([non_empty, empty]))
 
     def __len__(self):
         return len(self.crops)
 
     def __getitem__(self, idx):
-        row = self.crops.iloc[idx]
-        case_id = row.case_id
-        z, y, x = eval(row.position)
-        zw, yw, xw = eval(row.window_size)
-        self.file = h5py.File(self.filename, "r")
-        data = self.file[case_id][:, z:z + zw, y:y + yw, x:x + xw]
-        self.file.close()
-        im = data[0, :, :, :]
-        mask = data[1, :, :, :]
+        case_id, position, window = self.crops[idx]
+        im, mask = self.read_crop(case_id, position, window)
         try:
             return torch.from_numpy(im).unsqueeze(0).float(), torch.from_numpy(mask).long()
         except Exception as e:
-            print("Exception happened. Data shape: {}".format(data.shape))
+            print("Exception happened. Data shape: {}".format(im.shape))
@@ -0,0 +1,121 @@
+import torch
+import torch.multiprocessing
+import torch.nn as nn
+import torch.nn.functional as F
+
+from src.net import LOGIT_NETS, build_network
+from src.precision import autocast
+from src.utils import load_checkpoint
+
+
+def parse_member(spec):
+    "'net' or 'net:checkpoint' -> (net name, checkpoint name or None)"
+    net_name, _, checkpoint = spec.partition(':')
+    return net_name, checkpoint or None
+
+
+def load_member(net_name, checkpoint=None):
+    "(eval-mode net on the CPU, whether it outputs logits) of an ensemble member"
+    net = build_network(net_name)
+    if checkpoint is not None:
+        load_checkpoint(net, checkpoint)
+    return net.cpu().eval(), net_name in LOGIT_NETS
+
+
+def member_probabilities(predict, logits):
+    return F.softmax(predict.float(), dim=1) if logits else predict.float()
+
+
+class Ensemble(nn.Module):
+    """Mean class probabilities of several networks, each run on the same crop batch in turn.
+    Used as the Evaluator's net, so loading, the sliding window and scoring are shared by all members"""
+
+    def __init__(self, nets, logits):
+        super(Ensemble, self).__init__()
+        self.nets = nn.ModuleList(nets)
+        self.logits = list(logits)
+
+    def forward(self, x):
+        total = None
+        for net, logits in zip(self.nets, self.logits):
+            predict = member_probabilities(net(x), logits)
+            total = predict if total is None else total.add_(predict)
+        return total.div_(len(self.nets))
+
+
+def _member_worker(net, logits, threads, precision, inputs, outputs):
+    torch.set_num_threads(threads)
+    with torch.no_grad():
+        while True:
+            x = inputs.get()
+            if x is None:
+                break
+            with autocast(precision, 'cpu'):
+                outputs.put(member_probabilities(net(x), logits))
+
+
+class ProcessEnsemble(nn.Module):
+    """Ensemble running every member on the CPU in its own process with an equal share of the threads,
+    so the members work on a batch at the same time. Batches and probabilities are passed in shared memory.
+
+    The processes are forked with the nets, so create it before the nets have run in this process; `close`
+    stops them. Used as a context manager, they are stopped on leaving it and killed if it is left by an error.
+    """
+
+    def __init__(self, nets, logits, precision='fp32', threads=None):
+        super(ProcessEnsemble, self).__init__()
+        nets, logits = list(nets), list(logits)
+        threads = threads or max(torch.get_num_threads() // len(nets), 1)
+        context = torch.multiprocessing.get_context('fork')
+        self.inputs = [context.Queue() for _ in nets]
+        self.outputs = [context.Queue() for _ in nets]
+        self.processes = [context.Process(target=_member_worker, args=(net, member_logits, threads, precision,
+                                                                       inputs, outputs), daemon=True)
+                          for net, member_logits, inputs, outputs in zip(nets, logits, self.inputs, self.outputs)]
+        for process in self.processes:
+            process.start()
+
+    def forward(self, x):
+        x = x.cpu().float()
+        for inputs in self.inputs:
+            inputs.put(x)
+        total = self.outputs[0].get()
+        for outputs in self.outputs[1:]:
+            total.add_(outputs.get())
+        return total.div_(len(self.outputs))
+
+    def close(self):
+        if not self.processes:
+            return
+        for inputs in self.inputs:
+            inputs.put(None)
+        for process in self.processes:
+            process.join()
+        self.processes = []
+
+    def terminate(self):
+        "Kills the member processes without waiting for the batches they are working on"
+        for process in self.processes:
+            process.terminate()
+        for process in self.processes:
+            process.join()
+        self.processes = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, error_type, *args):
+        # After an error members may be blocked writing results nobody reads
+        if error_type is None:
+            self.close()
+        else:
+            self.terminate()
+
+
+def build_ensemble(specs, processes=False, precision='fp32'):
+    "Ensemble of the 'net:checkpoint' `specs`, with one CPU process per member if `processes`"
+    members = [load_member(*parse_member(spec)) for spec in specs]
+    nets, logits = zip(*members)
+    if processes:
+        return ProcessEnsemble(nets, logits, precision)
+    return Ensemble(nets, logits)
@@ -7,54 +7,97 @@ import time
 import src.starter.utils as starter
 import src.starter.visualize as vis
 import os
+import threading
+import contextlib
 import h5py
 import tqdm
 
-from src.score import score_function_fast
+from src.boundary import BOUNDARY_METRICS, BoundaryScorer
+from src.crop_index import load_crop_index
+from src.ensemble import build_ensemble
+from src.data import H5Dataset, h5_worker_init
+from src.export import load_exported
+from src.h5layout import case_shape, read_case, read_mask, read_spacing
+from src.inference import SlidingWindowInference
+from src.net import LOGIT_NETS
+from src.postprocess import PostProcessor
+from src.precision import autocast
+from src.predictions import write_prediction
+from src.score import class_metrics, score_function_counts
+from src.tta import flip_predict
 
 
-class H5EvalCropData(torch.utils.data.Dataset):
-    def __init__(self, filename, csv, case):
-        self.filename = filename
-        self.crops = pd.read_csv(csv)
-        self.cases = self.crops.case_id.unique()
-        self.case = case
-        self.window = eval(self.crops[self.crops.case_id == case].iloc[0].window_size)
+class H5EvalStreamData(H5Dataset):
+    """Crops of all evaluated cases in case order, each tagged with the number of its case in `cases`,
+    so a single DataLoader streams a whole evaluation run. `set_streamed` limits the streamed crops,
+    the others are predicted as background without being read"""
 
-        self.positions = [eval(pos) for pos in self.crops[self.crops.case_id == case].position.values]
+    def __init__(self, filename, csv, cases=None):
+        super(H5EvalStreamData, self).__init__(filename)
+        crops = load_crop_index(csv)
+        self.cases = [str(case) for case in (crops.cases if cases is None else cases)]
+        case_crops = [np.flatnonzero(crops.crops['case'] == crops.case_code(case)) for case in self.cases]
+        self.crops = crops.select(np.concatenate(case_crops) if case_crops else np.zeros(0, dtype=np.int64))
+        self.case_sizes = np.array([len(indices) for indices in case_crops])
+        self.case_numbers = np.repeat(np.arange(len(self.cases)), self.case_sizes)
+        self.case_starts = np.concatenate([[0], np.cumsum(self.case_sizes)])
+        self.set_streamed(np.ones(len(self.crops), dtype=bool))
+
+    def set_streamed(self, keep):
+        "Streams only the crops where `keep` (indexed like self.crops) is set"
+        self.keep = np.asarray(keep, dtype=bool)
+        self.streamed = np.flatnonzero(self.keep)
+        self.streamed_sizes = np.bincount(self.case_numbers[self.streamed], minlength=len(self.cases))
 
     def __len__(self):
-        return len(self.positions)
+        return len(self.streamed)
+
+    def case_positions(self, number):
+        return self.crops.positions[self.case_starts[number]:self.case_starts[number + 1]]
+
+    def case_skipped_positions(self, number):
+        start, stop = self.case_starts[number], self.case_starts[number + 1]
+        return self.crops.positions[start:stop][~self.keep[start:stop]]
+
+    def case_window(self, number):
+        return tuple(self.crops.windows[self.case_starts[number]].tolist())
+
+    def case_shape(self, number):
+        return case_shape(self.case_dataset(self.cases[number]), self.format)
+
+    def case_image(self, number):
+        return read_case(self.case_dataset(self.cases[number]), self.format)[0]
+
+    def case_mask(self, number):
+        return read_mask(self.case_dataset(self.cases[number]), self.format)
+
+    def case_spacing(self, number):
+        "Voxel size in mm; crops files written before it was stored give distances in voxels"
+        return read_spacing(self.case_dataset(self.cases[number])) or (1.0, 1.0, 1.0)
 
     def __getitem__(self, idx):
-        z, x, y = self.positions[idx]
-        zw, yw, xw = self.window
-        self.file = h5py.File(self.filename, "r")
-        dat = self.file[self.case][:, z:z + zw, x:x + xw, y:y + yw]
-        self.file.close()
-        im = dat[0, :, :, :]
-        mask = dat[1, :, :, :]
-        return torch.from_numpy(np.array([z, x, y])), \
-               torch.from_numpy(im).unsqueeze(0).float(), \
-               torch.from_numpy(mask).long()
-
-
-def entries_count_mask(im_shape, crop_shape, positions):
-    z, x, y = crop_shape
-    mask = np.zeros(im_shape)
-    for (zp, xp, yp) in positions:
-        mask[zp:zp + z, xp:xp + x, yp:yp + y] += 1
-    return mask
+        idx = self.streamed[idx]
+        case_id, position, window = self.crops[idx]
+        im, _ = self.read_crop(case_id, position, window)
+        return self.case_numbers[idx], np.array(position), torch.from_numpy(im).unsqueeze(0).float()
 
 
 class Evaluator:
-    def __init__(self, net, config, writer=None):
+    """Sliding window evaluation of a network over the val crops. With `logits` the net outputs logits
+    (LOGIT_NETS), which are turned into probabilities before they go into the sliding window"""
+
+    def __init__(self, net, config, writer=None, logits=False):
         net.eval()
         net.to(config['DEVICE'])
         self.device = config['DEVICE']
         self.net = net
+        self.logits = logits
         self.config = config
+        self.precision = config.get('PRECISION', 'fp32')
         self.scores = []
+        self.confusion = np.zeros((3, 3), dtype=np.int64)
+        self.boundary = {}
+        self.boundary_scorer = None
         self.global_step = 0
         self.epoch_number = 0
         if writer is None:
@@ -62,53 +105,183 @@ class Evaluator:
         else:
             self.tensorboard = writer
 
+    @classmethod
+    def from_exported(cls, filename, config, writer=None):
+        "Evaluator of a network saved by export_network.py; crops must have the window it was exported for"
+        net, metadata = load_exported(filename, device=config['DEVICE'])
+        print("Exported network loaded: {}".format(metadata))
+        return cls(net, config, writer, logits=metadata.get('net') in LOGIT_NETS)
+
+    @classmethod
+    def from_ensemble(cls, specs, config, writer=None, processes=False):
+        """Evaluator averaging the probabilities of the 'net:checkpoint' `specs` in one pass over the crops.
+        With `processes` every member runs in its own CPU process; call self.net.close() when done"""
+        if processes and torch.device(config['DEVICE']).type != 'cpu':
+            raise ValueError("Ensemble member processes run on the CPU, not on {}".format(config['DEVICE']))
+        net = build_ensemble(specs, processes=processes, precision=config.get('PRECISION', 'fp32'))
+        return cls(net, config, writer)
+
     def run(self, cases=None,
             crops_hdf_file="crops.hdf5",
             crops_csv_file="crops.csv",
             workers=0,
             batch_size=1,
             should_score=False,
-            eval_file=None):
-        if cases is None:
-            crops = pd.read_csv(crops_csv_file)
-            cases = crops.case_id.unique()
+            eval_file=None,
+            weighting='uniform',
+            accumulate_dtype=torch.float32,
+            postprocess_threads=1,
+            max_pending=2,
+            output_mode='float32',
+            output_compression='gzip',
+            boundary_metrics=False,
+            boundary_jobs=1,
+            crop_filters=(),
+            tta=None):
+        """`crops_csv_file` may also be a CropIndex loaded before, e.g. once for all epochs.
 
+        With `boundary_metrics` and `should_score`, also computes per-case Hausdorff 95 and average
+        symmetric surface distance, in a pool of `boundary_jobs` processes; they are kept in self.boundary.
+
+        `crop_filters` have a `name` and a keep(dataset) method returning a mask over dataset.crops, e.g.
+        cascade.CoarseLocalizer or prefilter.BodyPrefilter. Only crops every filter keeps go through
+        the network, the others add a background prediction to the sliding window.
+
+        `tta` holds the flip dims of tta.flip_variants; the variants of a batch run as one network batch
+        of len(tta) * batch_size crops and their mean prediction goes into the sliding window"""
         self.scores.clear()
-        with torch.no_grad():
-            for case in tqdm.tqdm(cases):
-                # Read ground truth mask
-                file = h5py.File(crops_hdf_file, "r")
-                gt_mask = file[case][1]
-                file.close()
-                # Create empty result mask
-                result_mask = np.zeros((3, *gt_mask.shape))
-                dataset = H5EvalCropData(crops_hdf_file, crops_csv_file, case)
-                entries_mask = entries_count_mask(gt_mask.shape, dataset.window, dataset.positions)
-                loader = torch.utils.data.DataLoader(dataset, batch_size=batch_size, num_workers=workers)
-                # Iterate over all crops and sum to the result mask
-                for idx, (positions, image, target) in enumerate(tqdm.tqdm(loader, ascii=True)):
-                    image, target = image.to(self.device), target.to(self.device)
-                    predict = self.net(image)
-                    z_window, x_window, y_window = dataset.window
-                    for batch_item in range(positions.shape[0]):
-                        z, x, y = positions[batch_item].numpy()
-                        result_mask[:, z:z + z_window, x:x + x_window, y:y + y_window] += predict[batch_item].cpu().numpy()
-
-                # Mean all prediction by crops
-                result_mask = (result_mask / entries_mask)[-gt_mask.shape[0]:]
-                if should_score:
-                    tensor = torch.from_numpy(result_mask)
-                    tensor = torch.softmax(tensor, 0)
-                    tensor = torch.argmax(tensor, 0, keepdim=True)
-                    predicted = tensor.numpy()
-                    score = score_function_fast(predicted, gt_mask)
-                    self.scores.append(score)
-                    self.tensorboard.add_scalar("val_score", score, global_step=self.global_step)
-
-                if eval_file is not None:
-                    pred_file = h5py.File(eval_file, "a")
-                    pred_file.create_dataset(case, data=result_mask)
-                    pred_file.close()
-                self.global_step += 1
-            self.tensorboard.add_scalar("val_epoch_score", np.mean(self.scores), global_step=self.epoch_number)
-            self.epoch_number += 1
+        self.confusion = np.zeros((3, 3), dtype=np.int64)
+        self.boundary = {}
+        # Whatever fails, the post-processing threads are stopped before the predictions file and the
+        # dataset are closed, and the boundary metric processes are terminated
+        with contextlib.ExitStack() as stack:
+            # Started before the loader workers, so the forked processes stay small
+            self.boundary_scorer = stack.enter_context(BoundaryScorer(boundary_jobs)) \
+                if should_score and boundary_metrics else None
+            dataset = H5EvalStreamData(crops_hdf_file, crops_csv_file, cases)
+            stack.callback(dataset.close)
+            keep = np.ones(len(dataset.crops), dtype=bool)
+            # filter name -> crops it rejects, a crop may be rejected by several filters
+            self.filter_skips = {}
+            for crop_filter in crop_filters:
+                kept = crop_filter.keep(dataset)
+                self.filter_skips[crop_filter.name] = int((~kept).sum())
+                keep &= kept
+            dataset.set_streamed(keep)
+            pred_file = stack.enter_context(h5py.File(eval_file, "a")) if eval_file is not None else None
+            # Scoring and writing run in the background while the network works on the next case;
+            # at most max_pending finished cases wait for them
+            post = stack.enter_context(PostProcessor(self.post_process, threads=postprocess_threads,
+                                                     max_pending=max_pending))
+            self.output = dict(mode=output_mode, compression=output_compression)
+            write_lock = threading.Lock()
+            loader = torch.utils.data.DataLoader(dataset, batch_size=batch_size, num_workers=workers,
+                                                 worker_init_fn=h5_worker_init)
+            inferences = {}
+
+            def open_case(number):
+                window = dataset.case_window(number)
+                if window not in inferences:
+                    inferences[window] = SlidingWindowInference(window, weighting=weighting, dtype=accumulate_dtype,
+                                                                device=self.device)
+                inference = inferences[window]
+                # Create empty result mask, skipped crops are predicted as background
+                result_mask = inference.volume(dataset.case_shape(number))
+                inference.add_background(result_mask, dataset.case_skipped_positions(number))
+                return inference, result_mask
+
+            # Cases before next_case are open or finished
+            next_case = 0
+
+            def finish_skipped_cases(until):
+                # Cases without a streamed crop never show up in a batch, finish them in case order
+                nonlocal next_case
+                while next_case < until:
+                    if dataset.streamed_sizes[next_case] == 0:
+                        inference, result_mask = open_case(next_case)
+                        self.finish_case(dataset, next_case, inference, result_mask, should_score, pred_file,
+                                         post, write_lock)
+                    next_case += 1
+
+            # case number -> [inference, result mask, crops still to come]
+            open_cases = {}
+            with torch.no_grad():
+                for case_numbers, positions, image in tqdm.tqdm(loader, ascii=True):
+                    image = image.to(self.device)
+                    with autocast(self.precision, self.device):
+                        predict = flip_predict(self.net, image, tta) if tta else self.net(image)
+                    if self.logits:
+                        # The sliding window averages probabilities, on the scale of the one-hot
+                        # background of skipped crops
+                        predict = torch.softmax(predict, 1, dtype=torch.float32)
+                    case_numbers, positions = case_numbers.numpy(), positions.numpy()
+                    # Batches are packed across case boundaries, add each case's part separately
+                    for number in np.unique(case_numbers):
+                        items = np.flatnonzero(case_numbers == number)
+                        if number not in open_cases:
+                            finish_skipped_cases(number + 1)
+                            open_cases[number] = [*open_case(number), dataset.streamed_sizes[number]]
+                        inference, result_mask, _ = open_cases[number]
+                        inference.add(result_mask, positions[items], predict[items])
+                        open_cases[number][2] -= len(items)
+                        if open_cases[number][2] == 0:
+                            # Last crop of the case arrived
+                            del open_cases[number]
+                            self.finish_case(dataset, number, inference, result_mask, should_score, pred_file,
+                                             post, write_lock)
+                finish_skipped_cases(len(dataset.cases))
+            post.close()
+            if self.boundary_scorer is not None:
+                self.boundary = self.boundary_scorer.results()
+                self.boundary_scorer.close()
+                self.log_boundary_metrics()
+        self.tensorboard.add_scalar("val_epoch_score", np.mean(self.scores), global_step=self.epoch_number)
+        self.skipped_crops, self.total_crops = int((~keep).sum()), len(keep)
+        self.tensorboard.add_scalar("val_skipped_crops", self.skipped_crops / max(self.total_crops, 1),
+                                    global_step=self.epoch_number)
+        for name, skipped in self.filter_skips.items():
+            self.tensorboard.add_scalar("val_skipped_crops_" + name, skipped, global_step=self.epoch_number)
+        if should_score:
+            # Metrics over all voxels of the run, per class
+            for name, values in class_metrics(self.confusion).items():
+                if name in ('dice', 'iou', 'precision', 'recall'):
+                    self.tensorboard.add_scalar("val_epoch_kidney_" + name, values[1], global_step=self.epoch_number)
+                    self.tensorboard.add_scalar("val_epoch_tumor_" + name, values[2], global_step=self.epoch_number)
+        self.epoch_number += 1
+
+    def finish_case(self, dataset, number, inference, result_mask, should_score, pred_file, post, write_lock):
+        # Mean all prediction by crops
+        result_mask = inference.finalize(result_mask, dataset.case_positions(number))
+        write_labels = pred_file is not None and self.output['mode'] == 'labels'
+        predicted = torch.argmax(result_mask, 0, keepdim=True).to(torch.uint8).cpu().numpy() \
+            if should_score or write_labels else None
+        probabilities = result_mask.cpu().numpy() if pred_file is not None and not write_labels else None
+        post.submit(dataset.cases[number], self.global_step, should_score, predicted, probabilities,
+                    lambda: dataset.case_mask(number), lambda: dataset.case_spacing(number), pred_file, write_lock)
+        self.global_step += 1
+
+    def post_process(self, case, step, should_score, predicted, probabilities, load_gt, load_spacing, pred_file,
+                     write_lock):
+        if should_score:
+            ground_truth = load_gt()
+            score, counts = score_function_counts(predicted, ground_truth)
+            with write_lock:
+                self.scores.append(score)
+                self.confusion += counts
+            self.tensorboard.add_scalar("val_score", score, global_step=step)
+            if self.boundary_scorer is not None:
+                self.boundary_scorer.submit(case, predicted, ground_truth, load_spacing())
+
+        if pred_file is not None:
+            with write_lock:
+                write_prediction(pred_file, case, probabilities=probabilities, labels=predicted, **self.output)
+
+    def log_boundary_metrics(self):
+        # Cases where a class is missing from the prediction or the ground truth have no finite distance
+        for name in BOUNDARY_METRICS:
+            values = np.array([metrics[name] for metrics in self.boundary.values()]).reshape(-1, 3)
+            for target, label in ((1, "kidney"), (2, "tumor")):
+                finite = values[:, target][np.isfinite(values[:, target])]
+                if len(finite):
+                    self.tensorboard.add_scalar("val_epoch_{}_{}".format(label, name), finite.mean(),
+                                                global_step=self.epoch_number)
@@ -0,0 +1,74 @@
+import json
+import time
+
+import torch
+import torch.nn as nn
+from torch.nn.utils.fusion import fuse_conv_bn_eval
+
+# Export metadata stored inside the TorchScript archive
+METADATA = 'export.json'
+
+
+def fold_batchnorm(net):
+    """Folds every BatchNorm3d that directly follows a Conv3d in an nn.Sequential into the conv weights,
+    leaving an nn.Identity in its place. Works on an eval-mode net in place; returns the number of folds.
+    GroupNorm depends on the statistics of each input and can't be folded"""
+    folded = 0
+    for module in net.modules():
+        if not isinstance(module, nn.Sequential):
+            continue
+        names = list(module._modules)
+        for name, next_name in zip(names, names[1:]):
+            conv, norm = module._modules[name], module._modules[next_name]
+            if isinstance(conv, nn.Conv3d) and isinstance(norm, nn.BatchNorm3d) and norm.track_running_stats:
+                module._modules[name] = fuse_conv_bn_eval(conv, norm)
+                module._modules[next_name] = nn.Identity()
+                folded += 1
+    return folded
+
+
+def export_network(net, window, fold=True):
+    """Frozen TorchScript module of an eval-mode net for (B, 1, *window) crops, with BatchNorm folded.
+    The net is traced: the blocks pass modules around and use activation checkpointing, which
+    torch.jit.script can't compile. Returns (module, metadata)"""
+    net.eval()
+    folded = fold_batchnorm(net) if fold else 0
+    example = torch.zeros((1, 1, *window))
+    with torch.no_grad():
+        module = torch.jit.trace(net, example)
+    module = torch.jit.freeze(module.eval())
+    metadata = dict(window=list(window), folded_batchnorms=folded)
+    return module, metadata
+
+
+def save_exported(module, metadata, filename):
+    torch.jit.save(module, filename, _extra_files={METADATA: json.dumps(metadata)})
+
+
+def load_exported(filename, device='cpu', optimize=True):
+    """(module, metadata) of an exported network; the module is called like the eager net in eval mode.
+    `optimize` applies the device specific graph rewrites (e.g. conv + ReLU fusion on CPU), which
+    can't be saved and so are done on loading"""
+    extra_files = {METADATA: ''}
+    module = torch.jit.load(filename, map_location=device, _extra_files=extra_files)
+    if optimize:
+        module = torch.jit.optimize_for_inference(module)
+    return module, json.loads(extra_files[METADATA] or '{}')
+
+
+def max_difference(first, second, inputs):
+    "Largest absolute difference of two networks' outputs for the same inputs"
+    with torch.no_grad():
+        return max((first(x) - second(x)).abs().max().item() for x in inputs)
+
+
+def latency(net, x, runs=5):
+    "Median seconds per call after a warm-up call"
+    with torch.no_grad():
+        net(x)
+        times = []
+        for _ in range(runs):
+            start = time.perf_counter()
+            net(x)
+            times.append(time.perf_counter() - start)
+    return sorted(times)[len(times) // 2]
@@ -0,0 +1,40 @@
+import contextlib
+
+import torch
+import torch.nn as nn
+from torch.utils.checkpoint import checkpoint
+
+# Blocks whose activations are recomputed in backward instead of being kept from the forward pass:
+# encoder - the downsampling blocks, decoder - the upsampling (and attention) blocks, all - both
+CHECKPOINTING = ['none', 'encoder', 'decoder', 'all']
+
+
+def checkpoint_flags(mode):
+    "(encoders, decoders) to recompute for a checkpointing mode"
+    if mode not in CHECKPOINTING:
+        raise ValueError("Unknown checkpointing '{}'. Must be one of {}".format(mode, CHECKPOINTING))
+    return mode in ('encoder', 'all'), mode in ('decoder', 'all')
+
+
+@contextlib.contextmanager
+def frozen_batchnorm_stats(block):
+    "Restores the running statistics of the block's BatchNorm layers on exit"
+    buffers = [buffer for module in block.modules() if isinstance(module, nn.modules.batchnorm._BatchNorm)
+               for buffer in module.buffers()]
+    saved = [buffer.clone() for buffer in buffers]
+    try:
+        yield
+    finally:
+        with torch.no_grad():
+            for buffer, value in zip(buffers, saved):
+                buffer.copy_(value)
+
+
+def run_block(block, recompute, *inputs):
+    """block(*inputs); with `recompute` during training its activations are dropped and computed again
+    in backward. The recomputation leaves the BatchNorm running statistics as the forward pass set them,
+    so they are updated once per step like without checkpointing"""
+    if recompute and block.training and torch.is_grad_enabled():
+        return checkpoint(block, *inputs, use_reentrant=False,
+                          context_fn=lambda: (contextlib.nullcontext(), frozen_batchnorm_stats(block)))
+    return block(*inputs)
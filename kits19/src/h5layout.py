@@ -0,0 +1,143 @@
+from math import gcd
+
+import numpy as np
+
+try:
+    # Registers the lz4/blosc HDF5 filters with h5py when installed
+    import hdf5plugin
+except ImportError:
+    hdf5plugin = None
+
+FORMAT_ATTR = 'format_version'
+# 1: one (2, D, H, W) float64 dataset per case holding [image, mask]
+# 2: a group per case with chunked, optionally compressed 'image' and uint8 'mask' datasets
+FORMAT_VERSION = 2
+COMPRESSIONS = ['none', 'gzip', 'lzf', 'lz4', 'blosc']
+# Group holding a (N, 5) [z, y, x, kid_size, tumor_size] table per case, with the build parameters
+# of the case as attributes. It is written after the case data, so it also marks the case complete
+CROP_INDEX = 'crop_index'
+
+
+def file_format(h5file):
+    version = int(h5file.attrs.get(FORMAT_ATTR, 1))
+    if version > FORMAT_VERSION:
+        raise ValueError("Unsupported crops file format {} in {}".format(version, h5file.filename))
+    return version
+
+
+def mark_format(h5file, version, window=None, stride=None):
+    h5file.attrs[FORMAT_ATTR] = version
+    if window is not None:
+        h5file.attrs['window'] = window
+    if stride is not None:
+        h5file.attrs['stride'] = stride
+
+
+def chunk_shape(shape, window, stride):
+    """Chunks of gcd(window, stride) per axis: every sliding window then covers whole chunks,
+    so a crop read never decompresses voxels outside of it"""
+    return tuple(max(1, min(s, gcd(w, st))) for s, w, st in zip(shape, window, stride))
+
+
+def compression_options(compression):
+    if compression is None or compression == 'none':
+        return {}
+    if compression == 'gzip':
+        return dict(compression='gzip', compression_opts=4, shuffle=True)
+    if compression == 'lzf':
+        return dict(compression='lzf', shuffle=True)
+    if compression in ('lz4', 'blosc'):
+        if hdf5plugin is None:
+            raise ImportError("Compression '{}' requires the hdf5plugin package".format(compression))
+        if compression == 'lz4':
+            return dict(hdf5plugin.LZ4())
+        return dict(hdf5plugin.Blosc(cname='lz4', clevel=5, shuffle=hdf5plugin.Blosc.SHUFFLE))
+    raise ValueError("Unknown compression '{}'. Must be one of {}".format(compression, COMPRESSIONS))
+
+
+def write_case(h5file, case_id, im, mask, version=FORMAT_VERSION, window=None, stride=None,
+               image_dtype='float16', compression=None, spacing=None):
+    "`spacing` is the voxel size in mm along each axis, stored as an attribute of the case node"
+    if h5file.get(case_id) is not None:
+        del h5file[case_id]
+    if version == 1:
+        node = h5file.create_dataset(case_id, data=np.array([im, mask]))
+    else:
+        chunks = chunk_shape(im.shape, window, stride) if window is not None else True
+        options = compression_options(compression)
+        node = h5file.create_group(case_id)
+        node.create_dataset('image', data=im.astype(image_dtype, copy=False), chunks=chunks, **options)
+        node.create_dataset('mask', data=mask.astype(np.uint8, copy=False), chunks=chunks, **options)
+    if spacing is not None:
+        node.attrs['spacing'] = np.asarray(spacing, dtype=np.float64)
+
+
+def read_crop(node, version, position, window):
+    "(image, mask) crop of a case node, as returned by h5file[case_id]"
+    z, y, x = position
+    zw, yw, xw = window
+    if version == 1:
+        dat = node[:, z:z + zw, y:y + yw, x:x + xw]
+        return dat[0], dat[1]
+    return node['image'][z:z + zw, y:y + yw, x:x + xw], node['mask'][z:z + zw, y:y + yw, x:x + xw]
+
+
+def read_case(node, version):
+    "Whole (image, mask) of a case node"
+    if version == 1:
+        dat = node[()]
+        return dat[0], dat[1]
+    return node['image'][()], node['mask'][()]
+
+
+def read_mask(node, version):
+    if version == 1:
+        return node[1]
+    return node['mask'][()]
+
+
+def read_mask_slab(node, version, start, stop):
+    "Mask slices start:stop of a case node"
+    if version == 1:
+        return node[1, start:stop]
+    return node['mask'][start:stop]
+
+
+def read_spacing(node):
+    "Voxel size of a case node, or None for files written before it was stored"
+    spacing = node.attrs.get('spacing')
+    return None if spacing is None else tuple(float(s) for s in spacing)
+
+
+def case_shape(node, version):
+    if version == 1:
+        return node.shape[1:]
+    return node['mask'].shape
+
+
+def case_ids(h5file):
+    return [name for name in h5file.keys() if name != CROP_INDEX]
+
+
+def write_case_crops(h5file, case_id, crops, build):
+    "`crops` holds [z, y, x, kid_size, tumor_size, body_size] rows, `build` the parameters the case was built with"
+    name = CROP_INDEX + '/' + case_id
+    if h5file.get(name) is not None:
+        del h5file[name]
+    dataset = h5file.create_dataset(name, data=np.asarray(crops, dtype=np.int64).reshape(-1, 6))
+    for key, value in build.items():
+        dataset.attrs[key] = value
+
+
+def read_case_crops(h5file, case_id):
+    "(crops, build) stored by write_case_crops, or (None, None) if the case was never completed"
+    dataset = h5file.get(CROP_INDEX + '/' + case_id)
+    if dataset is None:
+        return None, None
+    return dataset[()], dict(dataset.attrs)
+
+
+def delete_case(h5file, case_id):
+    for name in (case_id, CROP_INDEX + '/' + case_id):
+        if h5file.get(name) is not None:
+            del h5file[name]
@@ -0,0 +1,129 @@
+from collections import OrderedDict
+
+import numpy as np
+import torch
+
+WEIGHTINGS = ['uniform', 'gaussian']
+
+
+def gaussian_profiles(window, sigma_scale=0.125, min_weight=1e-4):
+    """Per-axis Gaussians centered in the window, 1 in the center. Each is clamped to min_weight ** (1 / 3),
+    so their outer product, the importance map, is at least `min_weight` and stays separable"""
+    profiles = []
+    for size in window:
+        coords = np.arange(size) - (size - 1) / 2
+        profile = np.exp(-coords ** 2 / (2 * (sigma_scale * size) ** 2))
+        profiles.append(torch.from_numpy(np.maximum(profile / profile.max(), min_weight ** (1 / 3))).float())
+    return profiles
+
+
+def gaussian_importance(window, sigma_scale=0.125, min_weight=1e-4):
+    "Separable Gaussian centered in the window, 1 in the center and at least `min_weight` at the border"
+    z, y, x = gaussian_profiles(window, sigma_scale, min_weight)
+    return z[:, None, None] * y[None, :, None] * x[None, None, :]
+
+
+def grid_starts(positions):
+    """Per-axis window starts if the (N, 3) positions are every combination of them, as the
+    prepare_data.positions grid is, otherwise None"""
+    starts = tuple(tuple(np.unique(positions[:, axis]).tolist()) for axis in range(3))
+    if np.prod([len(axis) for axis in starts]) != len(positions) or \
+            len(np.unique(positions, axis=0)) != len(positions):
+        return None
+    return starts
+
+
+class SlidingWindowInference:
+    """Accumulates per-crop predictions of a sliding window over a whole volume on the compute device.
+
+    Predictions are multiplied by a uniform or Gaussian importance map and added in place into a
+    (n_classes, *shape) volume of `dtype`; `finalize` divides by the summed importance. The map is
+    separable and the windows form a grid, so the summed importance is the outer product of three
+    1-D coverage profiles. Those are cached per (shape, window, grid) and divided out axis by axis,
+    no normalization volume is ever allocated.
+    """
+
+    def __init__(self, window, n_classes=3, weighting='uniform', dtype=torch.float32, device='cpu',
+                 max_cached_maps=4):
+        if weighting not in WEIGHTINGS:
+            raise ValueError("Unknown weighting '{}'. Must be one of {}".format(weighting, WEIGHTINGS))
+        self.window = tuple(int(w) for w in window)
+        self.n_classes = n_classes
+        self.weighting = weighting
+        self.dtype = dtype
+        self.device = device
+        if weighting == 'gaussian':
+            self.profiles = [profile.to(device, dtype) for profile in gaussian_profiles(self.window)]
+            self.importance = gaussian_importance(self.window).to(device, dtype)
+        else:
+            self.profiles = [torch.ones(size, dtype=dtype, device=device) for size in self.window]
+            self.importance = None
+        self.max_cached_maps = max_cached_maps
+        self._maps = OrderedDict()
+
+    def volume(self, shape):
+        return torch.zeros((self.n_classes, *shape), dtype=self.dtype, device=self.device)
+
+    def add(self, volume, positions, predictions):
+        """Adds a batch of (B, n_classes, *window) predictions at (B, 3) host positions.
+        Every crop is an in-place add into a strided view of the volume, so nothing leaves the device"""
+        zw, yw, xw = self.window
+        predictions = predictions.to(self.dtype)
+        if self.importance is not None:
+            predictions = predictions * self.importance
+        for (z, y, x), prediction in zip(np.asarray(positions).tolist(), predictions):
+            volume[:, z:z + zw, y:y + yw, x:x + xw] += prediction
+
+    def add_background(self, volume, positions, label=0):
+        "Adds a fixed one-hot `label` prediction at the (N, 3) positions, for crops the network skipped"
+        zw, yw, xw = self.window
+        weight = self.importance if self.importance is not None else 1
+        for z, y, x in np.asarray(positions).reshape(-1, 3).tolist():
+            volume[label, z:z + zw, y:y + yw, x:x + xw] += weight
+
+    def coverage(self, size, axis, starts):
+        "Summed importance profile along one axis of windows at `starts`"
+        profile = torch.zeros(size, dtype=self.dtype, device=self.device)
+        for start in starts:
+            profile[start:start + self.window[axis]] += self.profiles[axis]
+        # Voxels no window covers stay 0 instead of turning into NaN
+        return profile.clamp_(min=torch.finfo(self.dtype).tiny)
+
+    def normalization(self, shape, positions):
+        """(D, H, W) coverage profiles of the windows at `positions`, their outer product is the
+        summed importance. None if the positions don't form a grid"""
+        positions = np.asarray(positions).reshape(-1, 3)
+        shape = tuple(int(s) for s in shape)
+        starts = grid_starts(positions)
+        if starts is None:
+            return None
+        key = (shape, self.window, starts, self.weighting)
+        if key in self._maps:
+            self._maps.move_to_end(key)
+            return self._maps[key]
+        profiles = [self.coverage(size, axis, axis_starts)
+                    for axis, (size, axis_starts) in enumerate(zip(shape, starts))]
+        self._maps[key] = profiles
+        while len(self._maps) > self.max_cached_maps:
+            self._maps.popitem(last=False)
+        return profiles
+
+    def full_normalization(self, shape, positions):
+        "Summed importance volume, for positions that don't form a grid"
+        weight = self.importance if self.importance is not None else \
+            torch.ones(self.window, dtype=self.dtype, device=self.device)
+        norm = torch.zeros(shape, dtype=self.dtype, device=self.device)
+        zw, yw, xw = self.window
+        for z, y, x in np.asarray(positions).reshape(-1, 3).tolist():
+            norm[z:z + zw, y:y + yw, x:x + xw] += weight
+        return norm.clamp_(min=torch.finfo(self.dtype).tiny)
+
+    def finalize(self, volume, positions):
+        "Weighted mean of the accumulated predictions, in place"
+        profiles = self.normalization(volume.shape[1:], positions)
+        if profiles is None:
+            return volume.div_(self.full_normalization(volume.shape[1:], positions))
+        depth, height, width = profiles
+        volume.div_(depth[:, None, None])
+        volume.div_(height[:, None])
+        return volume.div_(width)
@@ -4,14 +4,17 @@ from src.unet3_dsv import unet_grid_attention_3D
 from src.unet3_dsv import unet_CT_multi_att_dsv_3D
 from src.utils import count_parameters
 
+# Networks of build_network that output logits in eval mode, UNet3D applies its softmax itself
+LOGIT_NETS = {'grid', 'dsv'}
 
-def build_network(net_name):
+
+def build_network(net_name, checkpointing='none'):
     if net_name == '3dunet':
-        net = UNet3D(1, 3, False)
+        net = UNet3D(1, 3, False, checkpointing=checkpointing)
     elif net_name == 'grid':
-        net = unet_grid_attention_3D(n_classes=3, in_channels=1)
+        net = unet_grid_attention_3D(n_classes=3, in_channels=1, checkpointing=checkpointing)
     elif net_name == 'dsv':
-        net = unet_CT_multi_att_dsv_3D(n_classes=3, in_channels=1)
+        net = unet_CT_multi_att_dsv_3D(n_classes=3, in_channels=1, checkpointing=checkpointing)
     else:
         raise NotImplementedError()
     print("Network {} created. Parameters: {}".format(net_name, count_parameters(net)))
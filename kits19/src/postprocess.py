@@ -0,0 +1,69 @@
+import queue
+import threading
+
+_STOP = object()
+
+
+class PostProcessor:
+    """Runs `process(*args)` for submitted items on background threads.
+
+    Items wait in a queue of at most `max_pending` entries; `submit` blocks while it is full,
+    so a producer that runs ahead is throttled instead of piling up finished volumes in memory.
+    `close` waits for every submitted item and re-raises the first error of a worker.
+    """
+
+    def __init__(self, process, threads=1, max_pending=2):
+        self.process = process
+        self.queue = queue.Queue(maxsize=max(max_pending, 1))
+        self.error = None
+        self.threads = [threading.Thread(target=self._work, daemon=True) for _ in range(max(threads, 1))]
+        for thread in self.threads:
+            thread.start()
+
+    def _work(self):
+        while True:
+            item = self.queue.get()
+            try:
+                if item is _STOP:
+                    return
+                if self.error is None:
+                    self.process(*item)
+            except Exception as e:
+                self.error = e
+            finally:
+                self.queue.task_done()
+
+    def submit(self, *args):
+        if self.error is not None:
+            raise self.error
+        self.queue.put(args)
+
+    def flush(self):
+        self.queue.join()
+        if self.error is not None:
+            raise self.error
+
+    def _stop(self):
+        for _ in self.threads:
+            self.queue.put(_STOP)
+        for thread in self.threads:
+            thread.join()
+        self.threads = []
+
+    def close(self):
+        self._stop()
+        if self.error is not None:
+            raise self.error
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            # Don't mask the original exception. The workers drop the items still queued and are joined,
+            # so nothing they use is closed under them
+            if self.error is None:
+                self.error = exc_value
+            self._stop()
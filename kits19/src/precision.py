@@ -0,0 +1,27 @@
+import torch
+
+# fp32 - no autocast; fp16 / bf16 - autocast of the forward pass to that dtype
+PRECISIONS = ['fp32', 'fp16', 'bf16']
+
+
+def autocast_dtype(precision, device):
+    "Reduced dtype of a precision on a device, None for fp32. CPU autocast only supports bf16"
+    if precision not in PRECISIONS:
+        raise ValueError("Unknown precision '{}'. Must be one of {}".format(precision, PRECISIONS))
+    if precision == 'fp32':
+        return None
+    if torch.device(device).type == 'cpu':
+        return torch.bfloat16
+    return torch.float16 if precision == 'fp16' else torch.bfloat16
+
+
+def autocast(precision, device):
+    "Context manager running the network in `precision`"
+    dtype = autocast_dtype(precision, device)
+    return torch.autocast(torch.device(device).type, dtype=dtype, enabled=dtype is not None)
+
+
+def grad_scaler(precision, device):
+    "Loss scaler for training; only fp16 gradients can underflow, otherwise it passes everything through"
+    return torch.amp.GradScaler(torch.device(device).type,
+                                enabled=autocast_dtype(precision, device) == torch.float16)
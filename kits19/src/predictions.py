@@ -0,0 +1,96 @@
+import h5py
+import numpy as np
+
+from src.h5layout import compression_options
+
+# float32 / float16 - class probabilities, uint8 - probabilities quantized to 1/255 steps,
+# labels - argmax label map only
+OUTPUT_MODES = ['float32', 'float16', 'uint8', 'labels']
+MODE_ATTR = 'mode'
+
+
+def prediction_chunks(shape):
+    "Chunks of a few slices holding all classes, so reading a slice range touches little else"
+    return tuple(shape[:-3]) + tuple(min(s, c) for s, c in zip(shape[-3:], (4, 256, 256)))
+
+
+def write_prediction(h5file, case, probabilities=None, labels=None, mode='float32', compression='gzip', n_classes=3):
+    """Stores a case prediction. `probabilities` is the (n_classes, D, H, W) averaged network output,
+    `labels` its argmax; only the one the mode needs has to be given"""
+    options = compression_options(compression)
+    if mode == 'labels':
+        if labels is None:
+            labels = np.argmax(probabilities, 0)
+        labels = np.asarray(labels, dtype=np.uint8).reshape(labels.shape[-3:])
+        dataset = h5file.create_dataset(case, data=labels, chunks=prediction_chunks(labels.shape), **options)
+        dataset.attrs['n_classes'] = probabilities.shape[0] if probabilities is not None else n_classes
+    elif mode == 'uint8':
+        quantized = np.round(np.clip(probabilities, 0, 1) * 255).astype(np.uint8)
+        dataset = h5file.create_dataset(case, data=quantized, chunks=prediction_chunks(quantized.shape), **options)
+        dataset.attrs['scale'] = 1 / 255
+    elif mode in ('float32', 'float16'):
+        data = probabilities.astype(mode, copy=False)
+        dataset = h5file.create_dataset(case, data=data, chunks=prediction_chunks(data.shape), **options)
+    else:
+        raise ValueError("Unknown output mode '{}'. Must be one of {}".format(mode, OUTPUT_MODES))
+    dataset.attrs[MODE_ATTR] = mode
+    return dataset
+
+
+class StoredPrediction:
+    """Lazy view of a stored case prediction, indexed like the (n_classes, D, H, W) probabilities.
+    Only the requested part is read from disk and dequantized"""
+
+    def __init__(self, dataset, n_classes=3):
+        self.dataset = dataset
+        # Files written before the output modes existed hold float64 probabilities
+        self.mode = dataset.attrs.get(MODE_ATTR, 'float32')
+        self.n_classes = int(dataset.attrs.get('n_classes', n_classes)) if self.mode == 'labels' \
+            else dataset.shape[0]
+
+    @property
+    def shape(self):
+        spatial = self.dataset.shape if self.mode == 'labels' else self.dataset.shape[1:]
+        return (self.n_classes, *spatial)
+
+    def __getitem__(self, key):
+        if not isinstance(key, tuple):
+            key = (key,)
+        if self.mode != 'labels':
+            data = self.dataset[key]
+            if self.mode == 'uint8':
+                return data.astype(np.float32) * np.float32(self.dataset.attrs['scale'])
+            return data.astype(np.float32, copy=False)
+        classes = np.arange(self.n_classes)[key[0] if key else slice(None)]
+        labels = self.dataset[key[1:]] if len(key) > 1 else self.dataset[()]
+        if np.ndim(classes) == 0:
+            return (labels == classes).astype(np.float32)
+        return (labels[None] == classes.reshape(-1, *[1] * labels.ndim)).astype(np.float32)
+
+    def labels(self, *key):
+        "Label map of the spatial `key`, e.g. prediction.labels(slice(10, 20))"
+        if self.mode == 'labels':
+            return self.dataset[key] if key else self.dataset[()]
+        return np.argmax(self[(slice(None),) + key], 0).astype(np.uint8)
+
+
+class PredictionReader:
+    "Opens a predictions file written by Evaluator; `reader[case]` is a StoredPrediction"
+
+    def __init__(self, filename):
+        self.file = h5py.File(filename, "r")
+
+    def cases(self):
+        return list(self.file.keys())
+
+    def __getitem__(self, case):
+        return StoredPrediction(self.file[case])
+
+    def close(self):
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
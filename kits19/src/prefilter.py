@@ -0,0 +1,30 @@
+from src.crop_index import summed_volume, window_sums
+
+
+class BodyPrefilter:
+    """Marks crops that are almost only air as trivially background.
+
+    A crop is kept if at least `min_voxels` of its voxels are body, counted by prepare_data.py above
+    BODY_HU and stored as body_size. Crops files written before body_size was stored have -1 there;
+    with a `threshold` on the normalized intensity their counts are computed from the case images,
+    otherwise those crops are all kept.
+    As a crop filter of Evaluator.run the skipped crops bypass the network and add a background prediction.
+    """
+
+    name = 'prefilter'
+
+    def __init__(self, min_voxels=1, threshold=None):
+        self.min_voxels = min_voxels
+        self.threshold = threshold
+
+    def keep(self, dataset):
+        body_size = dataset.crops.body_size.copy()
+        if self.threshold is not None:
+            for number in range(len(dataset.cases)):
+                start, stop = dataset.case_starts[number], dataset.case_starts[number + 1]
+                if (body_size[start:stop] >= 0).all():
+                    continue
+                table = summed_volume(dataset.case_image(number) > self.threshold, True)
+                body_size[start:stop] = window_sums(table, dataset.case_positions(number),
+                                                    dataset.case_window(number))
+        return (body_size < 0) | (body_size >= self.min_voxels)
@@ -1,10 +1,15 @@
 from numba import jit
 from sklearn.metrics import confusion_matrix
+import h5py
 import numpy as np
 import time
+import torch
 
+from src.h5layout import file_format, read_mask_slab
+from src.predictions import PredictionReader
 
-@jit(nopython=True)
+
+@jit(nopython=True, nogil=True)
 def dice_score(tp, fp, fn):
     denom = tp + fp + fn
     if denom == 0:
@@ -12,7 +17,7 @@ def dice_score(tp, fp, fn):
     return (2 * tp) / (2 * tp + fp + fn)
 
 
-@jit(nopython=True)
+@jit(nopython=True, nogil=True)
 def calculate_metrics(prediction, gt, target):
     tp = np.sum(np.logical_and(prediction == target, gt == target))
     fp = np.sum(np.logical_and(prediction == target, gt != target))
@@ -20,7 +25,7 @@ def calculate_metrics(prediction, gt, target):
     return (tp, fp, fn)
 
 
-@jit(nopython=True)
+@jit(nopython=True, nogil=True)
 def score_function_fast(prediction, ground_truth):
     pred_flat = prediction.flatten()
     gt_flat = ground_truth.flatten()
@@ -37,3 +42,110 @@ def score_function_fast(prediction, ground_truth):
         return kidney_score
     else:
         return (kidney_score + tumor_score) / 2
+
+
+@jit(nopython=True, nogil=True)
+def _confusion_counts(prediction, ground_truth, n_classes):
+    counts = np.zeros((n_classes, n_classes), dtype=np.int64)
+    pred_flat = prediction.reshape(-1)
+    gt_flat = ground_truth.reshape(-1)
+    for i in range(gt_flat.shape[0]):
+        counts[int(gt_flat[i]), int(pred_flat[i])] += 1
+    return counts
+
+
+def confusion_counts(prediction, ground_truth, n_classes=3):
+    """(n_classes, n_classes) histogram of (ground truth, prediction) label pairs, built in one fused pass.
+    Contiguous inputs are only viewed, not copied; shapes may differ by singleton axes"""
+    prediction, ground_truth = np.ascontiguousarray(prediction), np.ascontiguousarray(ground_truth)
+    # The compiled loop doesn't check its indices, a label out of range would write past the histogram
+    for name, labels in (('prediction', prediction), ('ground truth', ground_truth)):
+        if labels.size and (labels.min() < 0 or labels.max() >= n_classes):
+            raise ValueError("{} labels must be in [0, {}), got [{}, {}]".format(
+                name.capitalize(), n_classes, labels.min(), labels.max()))
+    return _confusion_counts(prediction, ground_truth, n_classes)
+
+
+def device_confusion_counts(prediction, ground_truth, n_classes=3):
+    """confusion_counts of label tensors, computed with one bincount on their device.
+    Returns an (n_classes, n_classes) int64 tensor there, so nothing is synchronized with the host"""
+    pairs = ground_truth.reshape(-1).long() * n_classes + prediction.reshape(-1).long()
+    return torch.bincount(pairs, minlength=n_classes * n_classes)[:n_classes * n_classes].view(n_classes, n_classes)
+
+
+def class_metrics(counts):
+    """Per-class metrics of a confusion histogram, as arrays indexed by class.
+    Metrics of a class absent from both volumes are NaN"""
+    counts = np.asarray(counts, dtype=np.float64)
+    tp = np.diag(counts)
+    fp = counts.sum(0) - tp
+    fn = counts.sum(1) - tp
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return dict(tp=tp, fp=fp, fn=fn,
+                    dice=2 * tp / (2 * tp + fp + fn),
+                    iou=tp / (tp + fp + fn),
+                    precision=tp / (tp + fp),
+                    recall=tp / (tp + fn),
+                    volume_error=(fp - fn) / (tp + fn))
+
+
+def score_from_counts(counts):
+    "Same value as score_function_fast, taken from a confusion histogram"
+    dice = class_metrics(counts)['dice']
+    scores = [dice[target] for target in (1, 2) if not np.isnan(dice[target])]
+    if not scores:
+        return 1
+    return float(np.mean(scores))
+
+
+def score_function_counts(prediction, ground_truth, n_classes=3):
+    "Single-pass replacement of score_function_fast; returns (score, confusion histogram)"
+    counts = confusion_counts(prediction, ground_truth, n_classes)
+    return score_from_counts(counts), counts
+
+
+class StreamingScorer:
+    "Accumulates a confusion histogram over parts of a volume; the result equals scoring it whole"
+
+    def __init__(self, n_classes=3):
+        self.n_classes = n_classes
+        self.counts = np.zeros((n_classes, n_classes), dtype=np.int64)
+
+    def update(self, prediction, ground_truth):
+        self.counts += confusion_counts(prediction, ground_truth, self.n_classes)
+
+    def score(self):
+        return score_from_counts(self.counts)
+
+    def metrics(self):
+        return class_metrics(self.counts)
+
+
+def score_slabs(prediction_slabs, ground_truth_slabs, n_classes=3):
+    "Scores two iterables of matching label slabs; returns (score, confusion histogram)"
+    scorer = StreamingScorer(n_classes)
+    for prediction, ground_truth in zip(prediction_slabs, ground_truth_slabs):
+        scorer.update(prediction, ground_truth)
+    return scorer.score(), scorer.counts
+
+
+def stored_slabs(read, depth, slab):
+    "Slabs of `slab` slices from read(start, stop), for a volume of `depth` slices"
+    for start in range(0, depth, slab):
+        yield read(start, min(start + slab, depth))
+
+
+def score_prediction_file(predictions_file, crops_hdf_file, cases=None, slab=16):
+    """Per-case (score, confusion histogram) of the predictions stored by Evaluator against the masks
+    of the crops file, reading `slab` slices of both at a time"""
+    results = {}
+    with PredictionReader(predictions_file) as predictions, h5py.File(crops_hdf_file, "r") as crops:
+        version = file_format(crops)
+        for case in (predictions.cases() if cases is None else cases):
+            prediction, mask = predictions[case], crops[case]
+            depth = prediction.shape[1]
+            results[case] = score_slabs(
+                stored_slabs(lambda start, stop: prediction.labels(slice(start, stop)), depth, slab),
+                stored_slabs(lambda start, stop: read_mask_slab(mask, version, start, stop), depth, slab),
+                prediction.n_classes)
+    return results
@@ -1,12 +1,18 @@
+import os
 from pathlib import Path
 
 import nibabel as nib
+import numpy as np
 
 
-def load_case(cid, interpolated=False):
+def get_data_path(interpolated=False):
     # Resolve location where data should be living
-    data_path = Path(__file__).parent.parent.parent / "data" if not interpolated \
-                else Path(__file__).parent.parent.parent / "data_interpolated"
+    return Path(__file__).parent.parent.parent / "data" if not interpolated \
+        else Path(__file__).parent.parent.parent / "data_interpolated"
+
+
+def get_case_path(cid, interpolated=False):
+    data_path = get_data_path(interpolated)
     if not data_path.exists():
         raise IOError(
             "Data path, {}, could not be resolved".format(str(data_path))
@@ -26,6 +32,61 @@ def load_case(cid, interpolated=False):
             "Case could not be found \"{}\"".format(case_path.name)
         )
 
-    vol = nib.load(str(case_path / "imaging.nii.gz"))
-    seg = nib.load(str(case_path / "segmentation.nii.gz"))
+    return case_path
+
+
+def load_case(cid, interpolated=False, keep_file_open=False):
+    """With `keep_file_open` the compressed files stay open between reads of the proxies, so reading a
+    volume in slabs decompresses it once instead of from the start for every slab"""
+    case_path = get_case_path(cid, interpolated)
+    vol = nib.load(str(case_path / "imaging.nii.gz"), keep_file_open=keep_file_open)
+    seg = nib.load(str(case_path / "segmentation.nii.gz"), keep_file_open=keep_file_open)
     return vol, seg
+
+
+def get_cache_path(interpolated=False):
+    return Path(__file__).parent.parent.parent / ("data_cache" if not interpolated else "data_interpolated_cache")
+
+
+def _save_atomic(target, data):
+    # Write to a temporary name first, so concurrent readers never see a partial file
+    tmp = target.with_name(target.stem + ".{}.tmp.npy".format(os.getpid()))
+    np.save(str(tmp), data)
+    os.replace(str(tmp), str(target))
+
+
+def _cache_volume(source, target):
+    image = nib.load(str(source))
+    proxy = image.dataobj
+    if getattr(proxy, 'slope', 1) == 1 and getattr(proxy, 'inter', 0) == 0:
+        # Keep the on-disk dtype (e.g. int16) when no intensity scaling is stored
+        data = proxy.get_unscaled()
+    else:
+        data = np.asanyarray(proxy)
+    _save_atomic(target, data)
+    return image.affine
+
+
+def load_case_mmap(cid, interpolated=False, cache_dir=None):
+    """Same case as load_case, as read-only np.memmap volumes plus the affine.
+
+    On first access the NIfTI files are decompressed into .npy files under `cache_dir`
+    (data_cache / data_interpolated_cache next to data by default); later calls only map them.
+    The cache is rebuilt when a source file is newer than its cached copy.
+    """
+    case_path = get_case_path(cid, interpolated)
+    cache_path = Path(cache_dir or get_cache_path(interpolated)) / case_path.name
+    cache_path.mkdir(parents=True, exist_ok=True)
+
+    affine_path = cache_path / "affine.npy"
+    volumes = []
+    for name in ("imaging", "segmentation"):
+        source, target = case_path / (name + ".nii.gz"), cache_path / (name + ".npy")
+        stale = not target.exists() or target.stat().st_mtime < source.stat().st_mtime
+        if stale or (name == "imaging" and not affine_path.exists()):
+            affine = _cache_volume(source, target)
+            if name == "imaging":
+                _save_atomic(affine_path, affine)
+        volumes.append(np.load(str(target), mmap_mode="r"))
+    vol, seg = volumes
+    return vol, seg, np.load(str(affine_path))
@@ -0,0 +1,110 @@
+import argparse
+import multiprocessing
+
+import numpy as np
+import pandas as pd
+from tqdm import tqdm
+
+import src.starter.utils as starter
+
+# HU histogram with 1 HU bins; values outside of the range fall into the first/last bin
+HU_MIN = -2048
+HU_MAX = 4096
+QUANTILES = [0.01, 0.05, 0.5, 0.95, 0.99]
+SLAB = 32
+
+STATS_COLUMNS = ["num_slices", "height", "width", "im_volume", "kidney_volume", "tumor_volume",
+                 "max_val", "min_val"] + ["hu_q{:02d}".format(int(q * 100)) for q in QUANTILES]
+
+
+def histogram_quantiles(histogram, quantiles, hu_min=HU_MIN):
+    "Left bin edges at which the cumulative histogram reaches each quantile"
+    cumulative = np.cumsum(histogram)
+    return [hu_min + int(np.searchsorted(cumulative, q * cumulative[-1])) for q in quantiles]
+
+
+def case_stats(case_id, interpolated=False, slab=SLAB):
+    """Statistics of a case in a single streaming pass.
+
+    NIfTI volumes are stored in Fortran order, so the last axis is read slab by slab: each slab is
+    contiguous on disk, and image min/max, HU histogram and label counts are taken from it at once.
+    Returns (stats, histogram).
+    """
+    # The files are kept open, otherwise every slab would decompress the file from its start again
+    im, mask = starter.load_case(case_id, interpolated=interpolated, keep_file_open=True)
+    num_slices, height, width = im.shape
+    histogram = np.zeros(HU_MAX - HU_MIN, dtype=np.int64)
+    labels = np.zeros(3, dtype=np.int64)
+    max_value, min_value = -np.inf, np.inf
+    for start in range(0, width, slab):
+        im_slab = np.asarray(im.dataobj[..., start:start + slab])
+        max_value = max(max_value, im_slab.max())
+        min_value = min(min_value, im_slab.min())
+        bins = np.clip(np.floor(im_slab), HU_MIN, HU_MAX - 1).astype(np.int64) - HU_MIN
+        histogram += np.bincount(bins.ravel(), minlength=len(histogram))
+        mask_slab = np.asarray(mask.dataobj[..., start:start + slab]).astype(np.int64, copy=False)
+        labels += np.bincount(mask_slab.ravel(), minlength=3)[:3]
+
+    stats = dict(num_slices=num_slices, height=height, width=width, im_volume=num_slices * height * width,
+                 kidney_volume=labels[1], tumor_volume=labels[2], max_val=max_value, min_val=min_value)
+    for column, value in zip(STATS_COLUMNS[8:], histogram_quantiles(histogram, QUANTILES)):
+        stats[column] = value
+    if interpolated:
+        spacing = im.affine
+        stats['captured_pixel_width'] = -spacing[0][2]
+        stats['captured_slice_thickness'] = -spacing[2][0]
+    return stats, histogram
+
+
+def _case_stats(task):
+    return case_stats(*task)
+
+
+def dataset_stats(case_ids, interpolated=False, jobs=1, slab=SLAB):
+    "Stats of every case, computed in a process pool of `jobs` workers; keeps case order"
+    tasks = [(case_id, interpolated, slab) for case_id in case_ids]
+    if jobs <= 1:
+        results = [case_stats(*task) for task in tqdm(tasks)]
+    else:
+        with multiprocessing.Pool(jobs) as pool:
+            results = list(tqdm(pool.imap(_case_stats, tasks), total=len(tasks)))
+    stats = pd.DataFrame([case for case, _ in results])
+    histograms = np.stack([histogram for _, histogram in results]) if results else None
+    return stats, histograms
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--interpolated", help="Use data_interpolated cases", action="store_true")
+    parser.add_argument("--jobs", help="Number of processes", type=int, default=multiprocessing.cpu_count())
+    parser.add_argument("--slab", help="Slices read at once", type=int, default=SLAB)
+    parser.add_argument("--output", help="Output csv (default: data_stats.csv / data_interpolated_stats.csv)",
+                        type=str, default=None)
+    parser.add_argument("--histograms", help="Save per-case HU histograms to this .npz file",
+                        type=str, default=None)
+    args = parser.parse_args()
+
+    data = pd.read_json(str(starter.get_data_path(args.interpolated) / "kits.json")) \
+        .assign(case_nid=lambda x: x['case_id'].str.slice(start=5))
+    if args.interpolated:
+        data = data[['case_id', 'case_nid']]
+    else:
+        data = data[[c for c in ['captured_pixel_width', 'captured_slice_thickness', 'case_id', 'case_nid']
+                     if c in data.columns]]
+
+    stats, histograms = dataset_stats(list(data['case_nid']), interpolated=args.interpolated,
+                                      jobs=args.jobs, slab=args.slab)
+    # Same column order and float formatting as the data_exploration notebook wrote
+    columns = (["captured_pixel_width", "captured_slice_thickness"] if args.interpolated else []) + STATS_COLUMNS
+    data = pd.concat([data.reset_index(drop=True), stats[columns].astype(float)], axis=1)
+    output = args.output or ("data_interpolated_stats.csv" if args.interpolated else "data_stats.csv")
+    data.to_csv(output, index=False)
+    print("Stats saved to {}".format(output))
+
+    if args.histograms is not None:
+        np.savez(args.histograms, case_id=data['case_id'].values, counts=histograms,
+                 edges=np.arange(HU_MIN, HU_MAX + 1))
+
+
+if __name__ == "__main__":
+    main()
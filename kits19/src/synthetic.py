@@ -0,0 +1,49 @@
+import h5py
+import numpy as np
+import pandas as pd
+
+from src.h5layout import mark_format, write_case
+
+
+def synthetic_case(shape, rng):
+    "Random normalized volume with an ellipsoid 'kidney' (1) holding a smaller 'tumor' (2)"
+    im = rng.random(shape)
+    mask = np.zeros(shape)
+    zz, yy, xx = np.ogrid[:shape[0], :shape[1], :shape[2]]
+    center = [rng.integers(s // 4, 3 * s // 4) for s in shape]
+    radius = [max(s // 6, 1) for s in shape]
+    dist = sum(((c - o) / r) ** 2 for c, o, r in zip((zz, yy, xx), center, radius))
+    mask[dist <= 1] = 1
+    mask[dist <= 0.3] = 2
+    return im, mask
+
+
+def synthetic_positions(shape, window, stride):
+    return [(z, y, x)
+            for z in range(0, shape[0] - window[0] + 1, stride[0])
+            for y in range(0, shape[1] - window[1] + 1, stride[1])
+            for x in range(0, shape[2] - window[2] + 1, stride[2])]
+
+
+def make_synthetic_crops(hdf5file, csvfile, n_cases=4, shape=(96, 256, 256), window=(32, 128, 128),
+                         stride=(16, 64, 64), seed=0, version=1, **layout):
+    """Write a crops HDF5/CSV pair laid out like the output of prepare_data.py.
+    `version` and `layout` (image_dtype, compression) are passed on to h5layout.write_case"""
+    rng = np.random.default_rng(seed)
+    crops_data = []
+    with h5py.File(hdf5file, "w") as cropsfile:
+        mark_format(cropsfile, version, window, stride)
+        for case_nid in range(n_cases):
+            case_id = "case_{:05d}".format(case_nid)
+            im, mask = synthetic_case(shape, rng)
+            for position in synthetic_positions(shape, window, stride):
+                z, y, x = position
+                cropped_mask = mask[z:z + window[0], y:y + window[1], x:x + window[2]]
+                crops_data.append([case_id, position, window, stride,
+                                   np.sum(cropped_mask == 1), np.sum(cropped_mask == 2)])
+            write_case(cropsfile, case_id, im, mask, version=version, window=window, stride=stride, **layout)
+    crops_data = pd.DataFrame(data=crops_data,
+                              columns=["case_id", "position", "window_size",
+                                       "stride", "kid_size", "tumor_size"])
+    crops_data.to_csv(csvfile)
+    return crops_data
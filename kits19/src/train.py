@@ -9,14 +9,17 @@ import numpy as np
 from tensorboardX import SummaryWriter
 
 from src.losses import SoftDiceLoss
-from src.score import score_function_fast
+from src.precision import autocast, grad_scaler
+from src.score import class_metrics, device_confusion_counts, score_from_counts
 from src.utils import save_checkpoint
 
 CHECKPOINT_STEP = 400
+# Training losses and metrics are accumulated on the device and logged every SCORE_STEP steps
+SCORE_STEP = 20
 
 
 class Trainer:
-    def __init__(self, net, config, limit=None, writer=None):
+    def __init__(self, net, config, limit=None, writer=None, score_step=SCORE_STEP):
         net.train()
         net.to(config['DEVICE'])
         self.device = config['DEVICE']
@@ -25,9 +28,13 @@ class Trainer:
         self.loss = nn.CrossEntropyLoss(weight=torch.FloatTensor([0.15, 1, 1]).to(config['DEVICE']))
         # self.loss = SoftDiceLoss(n_classes=3)
         self.optimizer = torch.optim.Adam(net.parameters(), lr=config['LR'], weight_decay=config['L2'])
+        self.precision = config.get('PRECISION', 'fp32')
+        self.scaler = grad_scaler(self.precision, self.device)
         self.global_step = 0
         self.epoch_number = 0
         self.scores = []
+        self.score_step = score_step
+        self.confusion = np.zeros((3, 3), dtype=np.int64)
         if writer is None:
             self.tensorboard = SummaryWriter()
         else:
@@ -39,24 +46,56 @@ class Trainer:
         self.scores.clear()
         for epoch in range(start_epoch + 1, start_epoch + epochs + 1):
             print(">>> Epoch %s" % epoch)
+            self.scores.clear()
+            self.confusion = np.zeros((3, 3), dtype=np.int64)
+            counts = torch.zeros((3, 3), dtype=torch.int64, device=self.device)
+            # Losses of the steps since the last log, read back together with the counts
+            losses = torch.zeros(self.score_step, device=self.device)
+            pending = 0
             for idx, (image, target) in enumerate(tqdm.tqdm(dataloader, ascii=True)):
                 image, target = image.to(self.device), target.to(self.device)
                 self.optimizer.zero_grad()
-                predict = self.net(image)
-                loss = self.loss(predict, target)
-                batch_prediction = torch.argmax(torch.softmax(predict.cpu(), 1), 1, keepdim=True)
-                score = score_function_fast(batch_prediction.numpy(), target.cpu().numpy())
-
-                loss.backward()
-                self.optimizer.step()
-                self.tensorboard.add_scalar("train_loss", loss.item(), global_step=self.global_step)
-                self.tensorboard.add_scalar("train_score", score, global_step=self.global_step)
+                with autocast(self.precision, self.device):
+                    predict = self.net(image)
+                    loss = self.loss(predict, target)
+                # softmax is monotonic, argmax alone gives the labels
+                counts += device_confusion_counts(torch.argmax(predict.detach(), 1), target)
+
+                self.scaler.scale(loss).backward()
+                self.scaler.step(self.optimizer)
+                self.scaler.update()
+                losses[pending] = loss.detach()
+                pending += 1
                 self.global_step += 1
+                if pending == self.score_step:
+                    self.log_score(counts, losses[:pending])
+                    pending = 0
                 if idx % CHECKPOINT_STEP == CHECKPOINT_STEP - 1:
                     save_checkpoint(self.net, {"epoch": epoch}, "{}-{}".format(epoch, self.config["CHECKPOINT"]))
+            self.log_score(counts, losses[:pending])
 
-            self.tensorboard.add_scalar("train_epoch_score", np.mean(self.scores), global_step=self.epoch_number)
+            # Dice over all voxels of the epoch
+            self.tensorboard.add_scalar("train_epoch_score", score_from_counts(self.confusion),
+                                        global_step=self.epoch_number)
+            metrics = class_metrics(self.confusion)
+            self.tensorboard.add_scalar("train_epoch_kidney_dice", metrics['dice'][1], global_step=self.epoch_number)
+            self.tensorboard.add_scalar("train_epoch_tumor_dice", metrics['dice'][2], global_step=self.epoch_number)
             self.epoch_number += 1
             save_checkpoint(self.net, {"epoch": epoch}, "{}-{}".format(epoch, self.config["CHECKPOINT"]))
             print(">>>Trainer epoch finished")
         print(">> Completed")
+
+    def log_score(self, counts, losses):
+        """Logs the per-step `losses` and the score of the steps accumulated in `counts` since the last call,
+        and resets the counts. These are the only host syncs of the training loop"""
+        for offset, value in enumerate(losses.tolist()):
+            self.tensorboard.add_scalar("train_loss", value, global_step=self.global_step - len(losses) + offset)
+        if not counts.any():
+            return
+        # On a CPU device .cpu() returns the tensor itself, so copy before resetting it
+        window = counts.cpu().numpy().copy()
+        counts.zero_()
+        self.confusion += window
+        score = score_from_counts(window)
+        self.scores.append(score)
+        self.tensorboard.add_scalar("train_score", score, global_step=self.global_step - 1)
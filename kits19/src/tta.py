@@ -0,0 +1,37 @@
+import itertools
+
+import torch
+
+# Flippable axes of a (B, C, D, H, W) crop batch
+FLIP_AXES = {'d': 2, 'h': 3, 'w': 4}
+
+
+def flip_variants(axes='dhw', count=None):
+    """Flip dims of the test-time augmentation variants over `axes`, the unflipped crop first and then
+    by number of flipped axes: [(), (2,), (3,), (4,), (2, 3), ...]. `count` keeps the first variants,
+    at most 2 ** len(axes)"""
+    unknown = set(axes) - set(FLIP_AXES)
+    if unknown:
+        raise ValueError("Unknown flip axes {}. Must be some of {}".format(sorted(unknown), list(FLIP_AXES)))
+    dims = sorted(set(FLIP_AXES[axis] for axis in axes))
+    variants = [flips for number in range(len(dims) + 1) for flips in itertools.combinations(dims, number)]
+    if count is not None:
+        if not 1 <= count <= len(variants):
+            raise ValueError("Flips over '{}' give 1 to {} variants, not {}".format(axes, len(variants), count))
+        variants = variants[:count]
+    return variants
+
+
+def flip_predict(net, image, variants):
+    """Mean prediction of `net` over the flipped `variants` of a crop batch. All variants go through the
+    network as a single batch of len(variants) * B crops; the outputs are flipped back and summed in place
+    on the device, so the sliding window gets one prediction per crop"""
+    if len(variants) == 1 and not variants[0]:
+        return net(image)
+    size = image.shape[0]
+    predict = net(torch.cat([image.flip(dims) if dims else image for dims in variants]))
+    merged = predict[:size].flip(variants[0]) if variants[0] else predict[:size]
+    for number, dims in enumerate(variants[1:], 1):
+        part = predict[number * size:(number + 1) * size]
+        merged += part.flip(dims) if dims else part
+    return merged.div_(len(variants))
@@ -8,6 +8,7 @@ import torch
 import torch.nn as nn
 import torch.nn.functional as F
 
+from src.grad_checkpoint import checkpoint_flags, run_block
 from src.utils import count_parameters
 
 
@@ -33,11 +34,14 @@ class UNet3D(nn.Module):
             in `DoubleConv` module. e.g. 'crg' stands for Conv3d+ReLU+GroupNorm3d.
             See `DoubleConv` for more info
         init_channel_number (int): number of feature maps in the first conv layer of the encoder; default: 64
+        checkpointing (string): Encoder/Decoder blocks to recompute in backward instead of keeping their
+            activations: 'none', 'encoder', 'decoder' or 'all'. See `src.grad_checkpoint`
     """
 
     def __init__(self, in_channels, out_channels, final_sigmoid, interpolate=True, conv_layer_order='crg',
-                 init_channel_number=64, **kwargs):
+                 init_channel_number=64, checkpointing='none', **kwargs):
         super(UNet3D, self).__init__()
+        self.checkpoint_encoders, self.checkpoint_decoders = checkpoint_flags(checkpointing)
 
         # number of groups for the GroupNorm
         num_groups = min(init_channel_number // 2, 32)
@@ -77,7 +81,7 @@ class UNet3D(nn.Module):
         # encoder part
         encoders_features = []
         for encoder in self.encoders:
-            x = encoder(x)
+            x = run_block(encoder, self.checkpoint_encoders, x)
             # reverse the encoder outputs to be aligned with the decoder
             encoders_features.insert(0, x)
 
@@ -89,7 +93,7 @@ class UNet3D(nn.Module):
         for decoder, encoder_features in zip(self.decoders, encoders_features):
             # pass the output from the corresponding encoder and the output
             # of the previous decoder
-            x = decoder(encoder_features, x)
+            x = run_block(decoder, self.checkpoint_decoders, encoder_features, x)
 
         x = self.final_conv(x)
 
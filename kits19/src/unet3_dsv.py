@@ -7,6 +7,7 @@ import torch.nn as nn
 import torch.nn.functional as F
 from torch.nn import init
 
+from src.grad_checkpoint import checkpoint_flags, run_block
 from src.utils import count_parameters
 
 
@@ -532,8 +533,9 @@ class UnetDsv3(nn.Module):
 class unet_CT_multi_att_dsv_3D(nn.Module):
 
     def __init__(self, feature_scale=4, n_classes=21, is_deconv=True, in_channels=3, scaling_filters=2,
-                 nonlocal_mode='concatenation', attention_dsample=(2, 2, 2), is_batchnorm=True):
+                 nonlocal_mode='concatenation', attention_dsample=(2, 2, 2), is_batchnorm=True, checkpointing='none'):
         super(unet_CT_multi_att_dsv_3D, self).__init__()
+        self.checkpoint_encoders, self.checkpoint_decoders = checkpoint_flags(checkpointing)
         self.is_deconv = is_deconv
         self.in_channels = in_channels
         self.is_batchnorm = is_batchnorm
@@ -594,31 +596,31 @@ class unet_CT_multi_att_dsv_3D(nn.Module):
 
     def forward(self, inputs):
         # Feature Extraction
-        conv1 = self.conv1(inputs)
+        conv1 = run_block(self.conv1, self.checkpoint_encoders, inputs)
         maxpool1 = self.maxpool1(conv1)
 
-        conv2 = self.conv2(maxpool1)
+        conv2 = run_block(self.conv2, self.checkpoint_encoders, maxpool1)
         maxpool2 = self.maxpool2(conv2)
 
-        conv3 = self.conv3(maxpool2)
+        conv3 = run_block(self.conv3, self.checkpoint_encoders, maxpool2)
         maxpool3 = self.maxpool3(conv3)
 
-        conv4 = self.conv4(maxpool3)
+        conv4 = run_block(self.conv4, self.checkpoint_encoders, maxpool3)
         maxpool4 = self.maxpool4(conv4)
 
         # Gating Signal Generation
-        center = self.center(maxpool4)
+        center = run_block(self.center, self.checkpoint_encoders, maxpool4)
         gating = self.gating(center)
 
         # Attention Mechanism
         # Upscaling Part (Decoder)
-        g_conv4, att4 = self.attentionblock4(conv4, gating)
-        up4 = self.up_concat4(g_conv4, center)
-        g_conv3, att3 = self.attentionblock3(conv3, up4)
-        up3 = self.up_concat3(g_conv3, up4)
-        g_conv2, att2 = self.attentionblock2(conv2, up3)
-        up2 = self.up_concat2(g_conv2, up3)
-        up1 = self.up_concat1(conv1, up2)
+        g_conv4, att4 = run_block(self.attentionblock4, self.checkpoint_decoders, conv4, gating)
+        up4 = run_block(self.up_concat4, self.checkpoint_decoders, g_conv4, center)
+        g_conv3, att3 = run_block(self.attentionblock3, self.checkpoint_decoders, conv3, up4)
+        up3 = run_block(self.up_concat3, self.checkpoint_decoders, g_conv3, up4)
+        g_conv2, att2 = run_block(self.attentionblock2, self.checkpoint_decoders, conv2, up3)
+        up2 = run_block(self.up_concat2, self.checkpoint_decoders, g_conv2, up3)
+        up1 = run_block(self.up_concat1, self.checkpoint_decoders, conv1, up2)
 
         # Deep Supervision
         dsv4 = self.dsv4(up4)
@@ -1137,8 +1139,9 @@ class unet_CT_dsv_3D(nn.Module):
 class unet_grid_attention_3D(nn.Module):
 
     def __init__(self, feature_scale=4, n_classes=21, is_deconv=True, in_channels=3,
-                 nonlocal_mode='concatenation', attention_dsample=(2,2,2), is_batchnorm=True):
+                 nonlocal_mode='concatenation', attention_dsample=(2,2,2), is_batchnorm=True, checkpointing='none'):
         super(unet_grid_attention_3D, self).__init__()
+        self.checkpoint_encoders, self.checkpoint_decoders = checkpoint_flags(checkpointing)
         self.is_deconv = is_deconv
         self.in_channels = in_channels
         self.is_batchnorm = is_batchnorm
@@ -1189,32 +1192,32 @@ class unet_grid_attention_3D(nn.Module):
 
     def forward(self, inputs):
         # Feature Extraction
-        conv1 = self.conv1(inputs)
+        conv1 = run_block(self.conv1, self.checkpoint_encoders, inputs)
         maxpool1 = self.maxpool1(conv1)
 
-        conv2 = self.conv2(maxpool1)
+        conv2 = run_block(self.conv2, self.checkpoint_encoders, maxpool1)
         maxpool2 = self.maxpool2(conv2)
 
-        conv3 = self.conv3(maxpool2)
+        conv3 = run_block(self.conv3, self.checkpoint_encoders, maxpool2)
         maxpool3 = self.maxpool3(conv3)
 
-        conv4 = self.conv4(maxpool3)
+        conv4 = run_block(self.conv4, self.checkpoint_encoders, maxpool3)
         maxpool4 = self.maxpool4(conv4)
 
         # Gating Signal Generation
-        center = self.center(maxpool4)
+        center = run_block(self.center, self.checkpoint_encoders, maxpool4)
         gating = self.gating(center)
 
         # Attention Mechanism
-        g_conv4, att4 = self.attentionblock4(conv4, gating)
-        g_conv3, att3 = self.attentionblock3(conv3, gating)
-        g_conv2, att2 = self.attentionblock2(conv2, gating)
+        g_conv4, att4 = run_block(self.attentionblock4, self.checkpoint_decoders, conv4, gating)
+        g_conv3, att3 = run_block(self.attentionblock3, self.checkpoint_decoders, conv3, gating)
+        g_conv2, att2 = run_block(self.attentionblock2, self.checkpoint_decoders, conv2, gating)
 
         # Upscaling Part (Decoder)
-        up4 = self.up_concat4(g_conv4, center)
-        up3 = self.up_concat3(g_conv3, up4)
-        up2 = self.up_concat2(g_conv2, up3)
-        up1 = self.up_concat1(conv1, up2)
+        up4 = run_block(self.up_concat4, self.checkpoint_decoders, g_conv4, center)
+        up3 = run_block(self.up_concat3, self.checkpoint_decoders, g_conv3, up4)
+        up2 = run_block(self.up_concat2, self.checkpoint_decoders, g_conv2, up3)
+        up1 = run_block(self.up_concat1, self.checkpoint_decoders, conv1, up2)
 
         final = self.final(up1)
 
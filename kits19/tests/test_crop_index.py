@@ -0,0 +1,38 @@
+import numpy as np
+import pytest
+
+from src.crop_index import CROP_DTYPE, CropIndex, summed_volume, window_sums
+
+
+@pytest.mark.parametrize("seed", range(3))
+def test_window_sums_match_naive_sums(seed):
+    rng = np.random.RandomState(seed)
+    shape = rng.randint(5, 20, size=3)
+    mask = rng.randint(0, 3, size=shape)
+    window = np.array([4, 6, 5])
+    positions = rng.randint(0, shape, size=(20, 3))
+    # Windows running over the far border and one starting past it are clipped
+    positions[0] = shape - window // 2
+    positions[1] = shape - 1
+    positions[2] = shape
+
+    for label in (0, 1, 2):
+        table = summed_volume(mask, label)
+        sums = window_sums(table, positions, window)
+        naive = [(mask[z:z + window[0], y:y + window[1], x:x + window[2]] == label).sum() for z, y, x in positions]
+        np.testing.assert_array_equal(sums, naive)
+
+
+def test_window_sums_of_boolean_mask():
+    rng = np.random.RandomState(3)
+    mask = rng.rand(10, 12, 14) > 0.5
+    positions = np.array([[0, 0, 0], [3, 4, 5], [9, 11, 13]])
+    sums = window_sums(summed_volume(mask, True), positions, (3, 3, 3))
+    np.testing.assert_array_equal(sums, [mask[z:z + 3, y:y + 3, x:x + 3].sum() for z, y, x in positions])
+
+
+def test_case_code_of_unknown_case():
+    crops = CropIndex(np.zeros(2, dtype=CROP_DTYPE), np.array(['case_00000', 'case_00003']))
+    assert crops.case_code('case_00003') == 1
+    with pytest.raises(KeyError, match='case_00001'):
+        crops.case_code('case_00001')
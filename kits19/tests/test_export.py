@@ -0,0 +1,35 @@
+import pytest
+import torch
+import torch.nn as nn
+
+from src.export import export_network
+from src.net import build_network
+
+
+def randomize_batchnorm(net, generator):
+    "Running statistics and affine parameters far from the identity, so an unfolded or wrongly folded norm shows"
+    for module in net.modules():
+        if isinstance(module, nn.BatchNorm3d):
+            module.running_mean.normal_(0, 0.5, generator=generator)
+            module.running_var.uniform_(0.5, 2, generator=generator)
+            module.weight.data.uniform_(0.5, 1.5, generator=generator)
+            module.bias.data.normal_(0, 0.5, generator=generator)
+
+
+@pytest.mark.parametrize("net_name", ['3dunet', 'grid', 'dsv'])
+def test_exported_network_matches_eager(net_name):
+    generator = torch.Generator().manual_seed(0)
+    net = build_network(net_name)
+    randomize_batchnorm(net, generator)
+    net.eval()
+    norms = sum(isinstance(module, nn.BatchNorm3d) for module in net.modules())
+    x = torch.randn((2, 1, 16, 32, 32), generator=generator)
+    with torch.no_grad():
+        expected = net(x)
+    module, metadata = export_network(net, (16, 32, 32))
+    with torch.no_grad():
+        exported = module(x)
+    # 3dunet uses GroupNorm, which isn't folded; BatchNorms that don't directly follow a conv stay as they are
+    assert metadata['folded_batchnorms'] <= norms
+    assert metadata['folded_batchnorms'] > 0 or norms == 0
+    assert torch.allclose(exported, expected, rtol=1e-4, atol=1e-4)
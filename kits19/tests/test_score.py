@@ -0,0 +1,50 @@
+import h5py
+import numpy as np
+import pytest
+
+from src.h5layout import FORMAT_VERSION, mark_format, write_case
+from src.predictions import write_prediction
+from src.score import confusion_counts, score_function_counts, score_function_fast, score_prediction_file
+
+
+@pytest.mark.parametrize("seed", range(4))
+def test_score_function_counts_matches_fast(seed):
+    rng = np.random.RandomState(seed)
+    shape = (1, 7, 9, 11)
+    # Seed 3 has no tumor in either volume
+    high = 2 if seed == 3 else 3
+    prediction = rng.randint(0, high, size=shape).astype(np.uint8)
+    ground_truth = rng.randint(0, high, size=shape[1:]).astype(np.uint8)
+    score, counts = score_function_counts(prediction, ground_truth)
+    assert score == pytest.approx(score_function_fast(prediction[0], ground_truth))
+    assert counts.sum() == ground_truth.size
+
+
+@pytest.mark.parametrize("label", [3, -1])
+def test_confusion_counts_rejects_labels_out_of_range(label):
+    labels = np.zeros((4, 4, 4), dtype=np.int64)
+    labels[1, 2, 3] = label
+    with pytest.raises(ValueError):
+        confusion_counts(labels, np.zeros_like(labels))
+    with pytest.raises(ValueError):
+        confusion_counts(np.zeros_like(labels), labels)
+
+
+def test_slab_scoring_matches_whole_volume(tmp_path):
+    rng = np.random.RandomState(5)
+    shape = (11, 6, 7)
+    image = rng.rand(*shape).astype(np.float32)
+    mask = rng.randint(0, 3, size=shape).astype(np.uint8)
+    probabilities = rng.rand(3, *shape).astype(np.float32)
+    crops_file, predictions_file = str(tmp_path / "crops.hdf5"), str(tmp_path / "predictions.hdf5")
+    with h5py.File(crops_file, "w") as h5file:
+        mark_format(h5file, FORMAT_VERSION)
+        write_case(h5file, "case_00000", image, mask)
+    with h5py.File(predictions_file, "w") as h5file:
+        write_prediction(h5file, "case_00000", probabilities)
+
+    # 4 doesn't divide the 11 slices, the last slab is shorter
+    score, counts = score_prediction_file(predictions_file, crops_file, slab=4)["case_00000"]
+    whole_score, whole_counts = score_function_counts(np.argmax(probabilities, 0).astype(np.uint8), mask)
+    np.testing.assert_array_equal(counts, whole_counts)
+    assert score == pytest.approx(whole_score)